@@ -0,0 +1,172 @@
+import heapq
+import random
+import time
+
+import numpy as np
+
+UNCOLORED = -1
+
+
+def dsatur_color(adj_ptr, adj, node_count: int, colors=None, color_count=4, chain_limit=None, ejection_limit=None,
+                 seed=None):
+    """Color a graph given as CSR arrays (neighbours of v are adj[adj_ptr[v]:adj_ptr[v + 1]]).
+
+    Nodes are colored in DSATUR order (most distinct neighbour colors first, ties to the highest degree).  When a
+    node sees all colors it is repaired by swapping a Kempe chain, or else by moving a neighbour that is the only
+    one holding its color.  Nodes that are still stuck take the color with the fewest holders around them and the
+    holders go back to be recolored, for at most ejection_limit ejected nodes.  This is best effort: whatever
+    cannot be colored after that gets color_count (the overflow color) and is counted in stats["failures"].
+    colors may hold a starting assignment (UNCOLORED for free nodes).  chain_limit bounds the size of a Kempe
+    chain that will be explored.  seed shuffles the order among equally ranked nodes (None: lowest node first).
+    Returns the color list and a dict of search statistics.
+    """
+    start = time.time()
+    ptr = np.asarray(adj_ptr).tolist()
+    adj_list = np.asarray(adj).tolist()
+    neighbours = [adj_list[ptr[v]:ptr[v + 1]] for v in range(min(node_count, len(ptr) - 1))]
+    neighbours.extend([] for _ in range(node_count - len(neighbours)))
+    full_mask = (1 << color_count) - 1
+    if chain_limit is None:
+        chain_limit = node_count
+    if ejection_limit is None:
+        ejection_limit = 100 + node_count // 10
+
+    colors = [UNCOLORED] * node_count if colors is None else list(colors)
+    stats = {"nodes": node_count, "edges": len(adj) // 2, "heap_pops": 0, "kempe_swaps": 0, "kempe_nodes": 0,
+             "neighbour_moves": 0, "ejections": 0, "failures": 0}
+
+    def color_mask(v):
+        mask = 0
+        for u in neighbours[v]:
+            c = colors[u]
+            if 0 <= c < color_count:
+                mask |= 1 << c
+        return mask
+
+    tie = list(range(node_count))
+    if seed is not None:
+        random.Random(seed).shuffle(tie)
+    # Only uncolored nodes ever read their mask, which keeps mostly precolored graphs cheap
+    masks = [color_mask(v) if colors[v] == UNCOLORED else 0 for v in range(node_count)]
+    heap = [(-bin(masks[v]).count("1"), -len(neighbours[v]), tie[v], v) for v in range(node_count)
+            if colors[v] == UNCOLORED]
+    heapq.heapify(heap)
+
+    def refresh(u):
+        # Recompute the saturation of an uncolored node after colors around it changed
+        mask = color_mask(u)
+        if mask != masks[u]:
+            masks[u] = mask
+            heapq.heappush(heap, (-bin(mask).count("1"), -len(neighbours[u]), tie[u], u))
+
+    def set_color(v, c):
+        colors[v] = c
+        for u in neighbours[v]:
+            if colors[u] == UNCOLORED:
+                refresh(u)
+
+    def kempe_chain(v, a, b, limit):
+        # Nodes colored a or b connected to the a-colored neighbours of v.  None if the chain reaches a b-colored
+        # neighbour of v (swapping it would not free a) or grows past limit.
+        chain = [u for u in neighbours[v] if colors[u] == a]
+        blocked = {u for u in neighbours[v] if colors[u] == b}
+        seen = set(chain)
+        i = 0
+        while i < len(chain):
+            for w in neighbours[chain[i]]:
+                if w not in seen and (colors[w] == a or colors[w] == b):
+                    if w in blocked:
+                        return None
+                    seen.add(w)
+                    chain.append(w)
+            i = i + 1
+            if len(chain) > limit:
+                return None
+        return chain
+
+    def kempe_repair(v):
+        # Cheap swaps first: every color pair is tried with a small chain limit before allowing larger chains
+        limit = 64
+        while True:
+            for a in range(color_count):
+                for b in range(color_count):
+                    if a == b:
+                        continue
+                    chain = kempe_chain(v, a, b, min(limit, chain_limit))
+                    if chain is None:
+                        continue
+                    for w in chain:
+                        colors[w] = b if colors[w] == a else a
+                    for w in chain:
+                        for u in neighbours[w]:
+                            if colors[u] == UNCOLORED and u != v:
+                                refresh(u)
+                    stats["kempe_swaps"] = stats["kempe_swaps"] + 1
+                    stats["kempe_nodes"] = stats["kempe_nodes"] + len(chain)
+                    return a
+            if limit >= chain_limit:
+                return UNCOLORED
+            limit = limit * 16
+
+    def move_neighbour(v):
+        # Free a color held by a single neighbour of v by moving that neighbour to one of its own free colors
+        holders = {}
+        for u in neighbours[v]:
+            c = colors[u]
+            if 0 <= c < color_count:
+                holders.setdefault(c, []).append(u)
+        for c, holder in holders.items():
+            if len(holder) != 1:
+                continue
+            u = holder[0]
+            free = full_mask & ~color_mask(u) & ~(1 << c)
+            if free:
+                set_color(u, (free & -free).bit_length() - 1)
+                stats["neighbour_moves"] = stats["neighbour_moves"] + 1
+                return c
+        return UNCOLORED
+
+    def repair(v):
+        c = kempe_repair(v)
+        if c == UNCOLORED:
+            c = move_neighbour(v)
+        return c
+
+    stuck = []
+    while heap:
+        neg_saturation, _, _, v = heapq.heappop(heap)
+        stats["heap_pops"] = stats["heap_pops"] + 1
+        if colors[v] != UNCOLORED or -neg_saturation != bin(masks[v]).count("1"):
+            continue
+
+        free = full_mask & ~masks[v]
+        c = (free & -free).bit_length() - 1 if free else repair(v)
+        if c == UNCOLORED:
+            stuck.append(v)
+        else:
+            set_color(v, c)
+
+    # Ejection phase, the heap is no longer consulted so refresh() pushes are simply ignored
+    rng = random.Random(node_count if seed is None else seed)
+    while stuck and stats["ejections"] < ejection_limit:
+        v = stuck.pop()
+        free = full_mask & ~color_mask(v)
+        c = (free & -free).bit_length() - 1 if free else repair(v)
+        if c == UNCOLORED:
+            holders = [[] for _ in range(color_count)]
+            for u in neighbours[v]:
+                if 0 <= colors[u] < color_count:
+                    holders[colors[u]].append(u)
+            fewest = min(len(holder) for holder in holders)
+            c = rng.choice([color for color in range(color_count) if len(holders[color]) == fewest])
+            for u in holders[c]:
+                colors[u] = UNCOLORED
+                stuck.append(u)
+            stats["ejections"] = stats["ejections"] + len(holders[c])
+        colors[v] = c
+
+    for v in stuck:
+        colors[v] = color_count
+    stats["failures"] = len(stuck)
+    stats["seconds"] = time.time() - start
+    return colors, stats
@@ -1,113 +1,403 @@
+import atexit
+import gc
 import itertools
+import multiprocessing
 import random
-import time
+from multiprocessing import shared_memory
 
-from trigrid import TriGrid
+import numpy as np
 
+import tracing
+from tracing import log
+from trigrid import TriCell, TriGrid, ID_DTYPE, NO_ID
 
-def generate(entity_count: int, tri_grid: TriGrid, iter_limit=0, rnd_seed=0):
+# "classic" grows one random body per step, "batch" advances the whole frontier per NumPy step and "parallel" grows
+# in synchronous rounds split into row bands across processes, giving the same map for any process count
+ENGINES = ("classic", "batch", "parallel")
+
+SPLITMIX_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+
+# Held by the border of bordered (negative seed) maps while the inside grows, never a region id
+BORDER_PLACEHOLDER = np.iinfo(ID_DTYPE).max
+
+
+def generate(entity_count: int, tri_grid: TriGrid, iter_limit=0, rnd_seed=0, engine="classic", progress=None):
     jj_mode = rnd_seed < 0
 
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown grow engine {engine}. Use one of {ENGINES}")
     if entity_count == 0:
         return
     random.seed(rnd_seed)
 
+    def run_engine(origins, grid):
+        if engine == "batch":
+            grow_batch(origins, grid, iter_limit, rnd_seed, progress=progress)
+        elif engine == "parallel":
+            grow_parallel(origins, grid, iter_limit, rnd_seed, progress=progress)
+        else:
+            grow(origins, grid, iter_limit, progress=progress)
+
     if jj_mode:
-        inner_grid = TriGrid(tri_grid.height - 4)
+        # Grow inside a view 2 cells in from every side, the border holds a placeholder so it is neither grown into
+        # nor seeded, and then joins the region of the view's top cell
+        inner_grid = TriGrid(tri_grid.height - 4, view_source=tri_grid, offset=(2, 2))
+        ids = tri_grid.root.ids
+        ids[tri_grid.cell_mask() & ~inner_grid.cell_mask()] = BORDER_PLACEHOLDER
         origins = seed(entity_count, inner_grid)
-        grow(origins, inner_grid, iter_limit)
-        tri_grid.set_all_id(inner_grid.get(0, 0).id)
+        run_engine(origins, inner_grid)
+        border_id = inner_grid.get(0, 0).id
+        ids[ids == BORDER_PLACEHOLDER] = NO_ID if border_id is None else border_id
+        tri_grid.mark_changed()
         tri_grid._seed_count = inner_grid._seed_count
-        i = 0
-        j = 0
-        while True:
-            inner_tri = inner_grid.get(i, j)
-            if inner_tri is None:
-                j = j + 1
-                if j > inner_grid.height:
-                    break
-                i = 0
-            else:
-                tri_grid.get(i + 2, j + 2).id = inner_tri.id
-                i = i + 1
+        tri_grid._seeds_ = inner_grid._seeds_
     else:
         origins = seed(entity_count, tri_grid)
-        grow(origins, tri_grid, iter_limit)
+        run_engine(origins, tri_grid)
+
+
+def cell_coordinates(index, height: int, up=True):
+    """Local (x, y) of cells given by their position in row order, in closed form (index arrays allowed)"""
+    index = np.asarray(index, dtype=np.int64)
+    if not up:
+        # Rows of a down grid are the rows of an up grid in reverse order
+        index = height * height - 1 - index
+    y = np.sqrt(index).astype(np.int64)
+    # Correct the float square root by one where it rounded across a perfect square
+    y = y - (y * y > index) + ((y + 1) * (y + 1) <= index)
+    x = index - y * y
+    if not up:
+        return 2 * y - x, height - 1 - y
+    return x, y
 
 
 def seed(seed_count: int, tri_grid: TriGrid):
-    origins = []
+    """Assign ids 0..seed_count-1 to distinct unassigned cells picked uniformly at random, returns their cells.
+
+    The cells are drawn without replacement in one go from the random module's state (seeded by generate).  Should
+    some of them already hold an id the draw is repeated over the unassigned cells only, so every seed lands.
+    """
     if seed_count == 0:
-        return origins
+        return []
 
     cell_count = tri_grid.height * tri_grid.height
+    rng = np.random.default_rng(random.getrandbits(64))
+    picks = rng.choice(cell_count, size=min(seed_count, cell_count), replace=False)
+    x, y = cell_coordinates(picks, tri_grid.height, tri_grid.up)
+    root_x = tri_grid.origin[0] + x + tri_grid.shear * y
+    root_y = tri_grid.origin[1] + y
+    ids = tri_grid.root.ids
 
-    if seed_count > cell_count:
-        print(f"More seeds then cells.  Limiting seed count to {cell_count}")
-        seed_count = cell_count
-
-    exclusions = []
-    for c in range(seed_count):
-        while True:
-            r = random.randrange(cell_count)
-            if r not in exclusions:
-                break
-        exclusions.append(r)
-        ry = 0
-        rx = 0
-        for ry in range(tri_grid.height):
-            r = r - (ry * 2 + 1)
-            if r < 0:
-                rx = ry * 2 + 1 + r
-                break
-
-        cell = tri_grid.get(rx, ry)
-        if cell.id is None:
-            cell.id = c
-            origins.append(cell)
+    if seed_count > cell_count or np.any(ids[root_y, root_x] != NO_ID):
+        free = np.flatnonzero(tri_grid.cell_mask() & (ids == NO_ID))
+        if seed_count > free.size:
+            log.warning("More seeds then free cells.  Limiting seed count to %s", free.size)
+            seed_count = free.size
+        root_y, root_x = np.divmod(rng.choice(free, size=seed_count, replace=False), ids.shape[1])
 
+    ids[root_y, root_x] = np.arange(seed_count, dtype=ids.dtype)
+    tri_grid.mark_changed()
     tri_grid._seed_count = seed_count
     tri_grid._seeds_ = list(range(seed_count))
 
-    return origins
+    return [TriCell(cx, cy, tri_grid.root) for cx, cy in zip(root_x.tolist(), root_y.tolist())]
 
 
-def grow(origins, tri_grid, iter_limit=0):
-    start = time.time()
+def grow(origins, tri_grid, iter_limit=0, progress=None):
+    # progress(filled, total) is called every 100 fills, it may raise to abort the growth.  Bodies are stacks of flat
+    # root indices and the ids are grown in a plain list, which is far cheaper per step than TriCell handles.
+    counters = tracing.stage("grow")
     fill_left = tri_grid.height * tri_grid.height
+    total = fill_left
 
     fill_left = fill_left - len(origins)
 
-    bodies = [[seed] for seed in origins]
+    root = tri_grid.root
+    width = root.ids.shape[1]
+    cells = root.ids.reshape(-1).tolist()
+    # l, r and v neighbour of every root position, -1 for none
+    lefts, rights, vs = root.flat_neighbours(np.arange(root.ids.size)).tolist()
+
+    bodies = [[y * width + x] for x, y in (cell.xy() for cell in origins)]
     iter_count = 0
+    randint = random.randint
+    choice = random.choice
 
-    while fill_left > 0:
+    try:
+        while fill_left > 0:
+            iter_count = iter_count + 1
+            if iter_limit == iter_count:
+                break
+
+            s = randint(0, len(bodies) - 1)
+            body = bodies[s]
+            s_cell = body[-1]
+            options = []
+            for side in (lefts[s_cell], rights[s_cell], vs[s_cell]):
+                if side >= 0 and cells[side] == NO_ID:
+                    options.append(side)
+
+            if len(options) > 0:
+                option = choice(options)
+                cells[option] = cells[s_cell]
+                fill_left = fill_left - 1
+                body.append(option)
+                if progress is not None and fill_left % 100 == 0:
+                    progress(total - fill_left, total)
+            else:
+                body.pop(-1)
+                if len(body) == 0:
+                    bodies.pop(s)
+    finally:
+        # Also on an abort from progress, so the cells grown so far are kept
+        root.ids[...] = np.asarray(cells, dtype=ID_DTYPE).reshape(root.ids.shape)
+        tri_grid.mark_changed()
+    counters.finish(cells=total - fill_left, steps=iter_count, bodies=len(origins))
+
+
+def grow_batch(origins, tri_grid, iter_limit=0, rnd_seed=0, growth_rate=0.5, progress=None):
+    # Every round each unassigned cell bordering a body picks one of its assigned neighbours at random and joins
+    # it with probability growth_rate.  All randomness comes from a generator seeded with rnd_seed.
+    counters = tracing.stage("grow_batch")
+    rng = np.random.default_rng(rnd_seed & 0xFFFFFFFFFFFFFFFF)
+    ids = tri_grid.root.ids.reshape(-1)
+    width = tri_grid.root.ids.shape[1]
+    region_count = tri_grid.seed_count()
+
+    def unassigned_neighbours(flat):
+        neighbours = tri_grid.flat_neighbours(flat).reshape(-1)
+        neighbours = neighbours[neighbours >= 0]
+        return np.unique(neighbours[ids[neighbours] == NO_ID])
+
+    seeded = np.asarray([y * width + x for x, y in (cell.xy() for cell in origins)], dtype=np.int64)
+    frontier = unassigned_neighbours(seeded)
+    iter_count = 0
+    total = tri_grid.height * tri_grid.height
+    fill_left = total - len(origins)
+
+    while frontier.size > 0:
         iter_count = iter_count + 1
         if iter_limit == iter_count:
-            return
+            break
 
-        s = random.randint(0, len(bodies) - 1)
-        body = bodies[s]
-        s_cell = body[-1]
-        options = []
+        neighbours = tri_grid.flat_neighbours(frontier)
+        neighbour_ids = np.where(neighbours >= 0, ids[neighbours], NO_ID)
+        # Random key per candidate, the assigned neighbour with the highest key donates its id
+        keys = rng.random(neighbours.shape)
+        keys[(neighbour_ids < 0) | (neighbour_ids >= region_count)] = -1
+        choice = keys.argmax(axis=0)
+        chosen_ids = neighbour_ids[choice, np.arange(frontier.size)]
+        claim = (chosen_ids >= 0) & (chosen_ids < region_count) & (rng.random(frontier.size) < growth_rate)
 
-        def eval_side(side):
-            if side is not None:
-                if side.id is None:
-                    options.append(side)
+        claimed = frontier[claim]
+        ids[claimed] = chosen_ids[claim]
+        frontier = np.union1d(frontier[~claim], unassigned_neighbours(claimed))
+        fill_left = fill_left - claimed.size
+        if progress is not None:
+            progress(total - fill_left, total)
 
-        for adj in s_cell.lrv():
-            eval_side(adj)
+    tri_grid.mark_changed()
+    counters.finish(cells=total - fill_left, rounds=iter_count, bodies=len(origins))
 
-        if len(options) > 0:
-            option = random.choice(options)
-            option.id = s_cell.id
-            fill_left = fill_left - 1
-            body.append(option)
-            if fill_left % 100 == 0:
-                print(f"remaining={fill_left} after {iter_count}")
-        else:
-            body.pop(-1)
-            if len(body) == 0:
-                bodies.pop(s)
-    print(f"grow time:{time.time() - start}s")
+
+def splitmix64(z):
+    """splitmix64 finaliser of a uint64 array, wrapping arithmetic"""
+    z = np.asarray(z, dtype=np.uint64)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+def region_streams(rnd_seed: int, region_count: int) -> np.ndarray:
+    """Key of the RNG stream of every region, draw n of region r is splitmix64(streams[r] + GAMMA * (n + 1))"""
+    base = splitmix64(np.asarray([rnd_seed & 0xFFFFFFFFFFFFFFFF], dtype=np.uint64))
+    return splitmix64(base + SPLITMIX_GAMMA * np.arange(1, region_count + 1, dtype=np.uint64))
+
+
+def sorted_unique(cells: np.ndarray) -> np.ndarray:
+    # np.unique without its hash table, which is several times slower than a sort on these flat index arrays
+    cells = np.sort(cells)
+    return cells[np.concatenate(([True], cells[1:] != cells[:-1]))] if cells.size else cells
+
+
+def grow_band(src: np.ndarray, dst: np.ndarray, mask: np.ndarray, neighbour_grid: TriGrid, streams: np.ndarray,
+              round_index: int, threshold: np.uint64, rows: (int, int), frontier: np.ndarray, incoming: np.ndarray,
+              last_claims: np.ndarray):
+    """One synchronous round for root rows [rows[0], rows[1]): reads src and writes the cells it claims to dst.
+
+    frontier holds the band's unassigned cells next to a region (flat root indices), incoming the cells next to the
+    claims of other bands that fall in these rows and last_claims the band's claims of the previous round, which
+    were written to src only and are now copied to dst.  Every frontier cell takes one draw from the stream of each
+    region it borders, counted by round and cell.  The lowest draw wins the cell when it is below threshold,
+    otherwise the cell waits for the next round.  Nothing but src is read, so the result does not depend on how the
+    rows are split.  Returns (frontier, outgoing, claims): the next frontier, the cells next to this round's claims
+    outside the band and the claimed cells.
+    """
+    y0, y1 = rows
+    width = src.shape[1]
+    src_flat = src.reshape(-1)
+    dst_flat = dst.reshape(-1)
+    dst_flat[last_claims] = src_flat[last_claims]
+
+    flat = sorted_unique(np.concatenate((frontier, incoming)))
+    flat = flat[(src_flat[flat] == NO_ID) & mask.reshape(-1)[flat]]
+    neighbours = neighbour_grid.flat_neighbours(flat)
+    region = np.where(neighbours >= 0, src_flat[neighbours], NO_ID)
+    # Only grown regions donate, so placeholder ids around a view stay put
+    donor = (region >= 0) & (region < streams.size)
+    flat = flat[donor.any(axis=0)]
+    region = region[:, donor.any(axis=0)]
+    donor = donor[:, donor.any(axis=0)]
+
+    counter = np.uint64(round_index) * np.uint64(src.size) + flat.astype(np.uint64) + np.uint64(1)
+    draws = splitmix64(streams[np.where(donor, region, 0)] + SPLITMIX_GAMMA * counter)
+    draws[~donor] = np.iinfo(np.uint64).max
+    choice = draws.argmin(axis=0)
+    columns = np.arange(flat.size)
+    claim = draws[choice, columns] < threshold
+    claims = flat[claim]
+    dst_flat[claims] = region[choice, columns][claim]
+
+    grown = neighbour_grid.flat_neighbours(claims).reshape(-1)
+    grown = grown[grown >= 0]
+    grown = grown[src_flat[grown] == NO_ID]
+    inside = (grown >= y0 * width) & (grown < y1 * width)
+    return np.concatenate((flat[~claim], grown[inside])), grown[~inside], claims
+
+
+# Grids with fewer cells than this grow with grow_batch, the rounds of grow_parallel cost more in task traffic than
+# they save
+PARALLEL_MIN_CELLS = 250_000
+
+# Shared buffers of a grow_parallel worker process, attached on the first task of each call
+_band_state = None
+
+# (processes, pool) kept from one grow_parallel call to the next
+_band_pool = None
+
+
+def _attach_band_state(setup):
+    global _band_state
+    names, shape, height, up, region_count, threshold = setup
+    if _band_state is not None and _band_state[0] == names:
+        return _band_state
+    if _band_state is not None:
+        blocks = _band_state[1]
+        _band_state = None
+        # The grid's root points to itself, so the arrays into the blocks are only gone after a collection
+        gc.collect()
+        for block in blocks:
+            block.close()
+    blocks = [shared_memory.SharedMemory(name=name) for name in names]
+    buffers = [np.ndarray(shape, dtype=ID_DTYPE, buffer=block.buf) for block in blocks[:2]]
+    mask = np.ndarray(shape, dtype=bool, buffer=blocks[2].buf)
+    streams = np.ndarray(region_count, dtype=np.uint64, buffer=blocks[3].buf)
+    _band_state = names, blocks, buffers, mask, TriGrid(height, up, ids=buffers[0]), streams, threshold
+    return _band_state
+
+
+def _grow_band_task(task):
+    setup, round_index, rows, frontier, incoming, last_claims = task
+    _, _, buffers, mask, neighbour_grid, streams, threshold = _attach_band_state(setup)
+    src = buffers[round_index % 2]
+    dst = buffers[1 - round_index % 2]
+    return grow_band(src, dst, mask, neighbour_grid, streams, round_index, threshold, rows, frontier, incoming,
+                     last_claims)
+
+
+def band_pool(processes: int):
+    """Worker pool of grow_parallel, kept for later calls and rounds.  Started with spawn, so a caller with threads
+    running (the GUI) is not forked."""
+    global _band_pool
+    if _band_pool is not None and _band_pool[0] != processes:
+        _band_pool[1].terminate()
+        _band_pool = None
+    if _band_pool is None:
+        _band_pool = processes, multiprocessing.get_context("spawn").Pool(processes)
+        atexit.register(_band_pool[1].terminate)
+    return _band_pool[1]
+
+
+def grow_parallel(origins, tri_grid: TriGrid, iter_limit=0, rnd_seed=0, growth_rate=0.5, processes=None,
+                  progress=None):
+    # Synchronous rounds over a double buffered copy of the ids, the rows are split into bands that worker processes
+    # grow from shared memory.  Each band only visits its frontier, so a round costs O(frontier) rather than
+    # O(cells).  Each region draws from its own splitmix64 stream keyed on rnd_seed, so the map is the same for any
+    # number of processes.  Grids below PARALLEL_MIN_CELLS go to grow_batch instead.
+    if tri_grid.height * tri_grid.height < PARALLEL_MIN_CELLS:
+        grow_batch(origins, tri_grid, iter_limit, rnd_seed, growth_rate, progress)
+        return
+    counters = tracing.stage("grow_parallel")
+    root = tri_grid.root
+    shape = root.ids.shape
+    width = shape[1]
+    mask = tri_grid.cell_mask()
+    streams = region_streams(rnd_seed, tri_grid.seed_count())
+    threshold = np.uint64(min(int(growth_rate * 2.0 ** 64), 2 ** 64 - 1))
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if multiprocessing.current_process().daemon:
+        processes = 1
+    band_rows = -(-shape[0] // (processes * 4 if processes > 1 else 1))
+    bands = [(y0, min(y0 + band_rows, shape[0])) for y0 in range(0, shape[0], band_rows)]
+
+    def route(cells):
+        # Splits flat cells into one array per band
+        cells = sorted_unique(cells)
+        bounds = np.searchsorted(cells, [y0 * width for y0, _ in bands] + [shape[0] * width])
+        return [cells[bounds[b]:bounds[b + 1]] for b in range(len(bands))]
+
+    seeded = np.asarray([y * width + x for x, y in (cell.xy() for cell in origins)], dtype=np.int64)
+    frontiers = route(np.zeros(0, dtype=np.int64))
+    incoming = route(root.flat_neighbours(seeded).reshape(-1))
+    last_claims = route(np.zeros(0, dtype=np.int64))
+
+    total = tri_grid.height * tri_grid.height
+    filled = len(origins)
+    iter_count = 0
+    rounds = 0
+    blocks = []
+    setup = None
+    if processes > 1:
+        blocks = [shared_memory.SharedMemory(create=True, size=max(size, 1))
+                  for size in (root.ids.nbytes, root.ids.nbytes, mask.nbytes, streams.nbytes)]
+        buffers = [np.ndarray(shape, dtype=ID_DTYPE, buffer=block.buf) for block in blocks[:2]]
+        np.ndarray(shape, dtype=bool, buffer=blocks[2].buf)[...] = mask
+        np.ndarray(streams.shape, dtype=np.uint64, buffer=blocks[3].buf)[...] = streams
+        setup = tuple(block.name for block in blocks), shape, root.height, root.up, streams.size, threshold
+    else:
+        buffers = [np.empty(shape, dtype=ID_DTYPE) for _ in range(2)]
+    try:
+        buffers[0][...] = root.ids
+        buffers[1][...] = root.ids
+
+        while any(f.size for f in frontiers) or any(i.size for i in incoming):
+            iter_count = iter_count + 1
+            if iter_limit == iter_count:
+                break
+            tasks = [(rounds, rows, frontiers[b], incoming[b], last_claims[b]) for b, rows in enumerate(bands)]
+            if setup is not None:
+                results = band_pool(processes).map(_grow_band_task, [(setup,) + task for task in tasks])
+            else:
+                results = [grow_band(buffers[rounds % 2], buffers[1 - rounds % 2], mask, root, streams, round_index,
+                                     threshold, rows, frontier, band_incoming, band_claims)
+                           for round_index, rows, frontier, band_incoming, band_claims in tasks]
+            rounds = rounds + 1
+            frontiers = [frontier for frontier, _, _ in results]
+            incoming = route(np.concatenate([outgoing for _, outgoing, _ in results]))
+            last_claims = [claims for _, _, claims in results]
+            filled = filled + sum(claims.size for claims in last_claims)
+            if progress is not None:
+                progress(filled, total)
+        # The buffer written last holds every claim
+        root.ids[...] = buffers[rounds % 2]
+    finally:
+        # The arrays must go before the shared memory they point into can be closed.  Workers keep their mapping
+        # until the next call, unlinking only drops the name.
+        del buffers
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    tri_grid.mark_changed()
+    counters.finish(cells=filled, rounds=rounds, bodies=len(origins))
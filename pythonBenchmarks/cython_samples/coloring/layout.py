@@ -0,0 +1,132 @@
+import collections
+
+import networkx as nx
+import numpy as np
+
+from trigrid import TriGrid
+
+# Up to this many nodes kamada-kawai is affordable and gives the nicest picture
+SMALL_GRAPH = 300
+
+
+class LayoutCache:
+    """Node positions keyed on graph structure (node and edge sequence), least recently used entries dropped.
+
+    The key holds the node and edge tuples themselves, so a hit compares them in full and two graphs with colliding
+    hashes never share positions.
+    """
+
+    def __init__(self, size=8):
+        self.size = size
+        self._entries = collections.OrderedDict()
+
+    @staticmethod
+    def key(graph: nx.Graph, kind: str):
+        return kind, tuple(graph.nodes), tuple(graph.edges)
+
+    def get(self, graph: nx.Graph, kind: str, build):
+        key = self.key(graph, kind)
+        pos = self._entries.get(key)
+        if pos is None:
+            pos = build()
+            self._entries[key] = pos
+            if len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(key)
+        return pos
+
+
+layout_cache = LayoutCache()
+
+
+def cell_xy(grid: TriGrid, x, y):
+    """Plot coordinates (x right, y up, one unit per row) of cell centres given in root coordinates"""
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    return (x - y) / 2, -y
+
+
+def region_centroids(grid: TriGrid) -> np.ndarray:
+    """(region_count, 2) array of the mean plot position of each region's cells"""
+    index = grid.region_index()
+    y, x = np.divmod(index.cell_flat, grid.ids.shape[1])
+    px, py = cell_xy(grid, x, y)
+    region = grid.ids.reshape(-1)[index.cell_flat]
+    counts = np.maximum(np.bincount(region, minlength=index.region_count), 1)
+    return np.stack((np.bincount(region, px, index.region_count) / counts,
+                     np.bincount(region, py, index.region_count) / counts), axis=1)
+
+
+def sparse_force_layout(graph: nx.Graph, pos=None, iterations=50, samples=8, seed=0):
+    """Fruchterman-Reingold style layout in O((nodes * samples + edges) * iterations).
+
+    Edges attract as usual but every node is only repelled by a few randomly sampled nodes per iteration, which
+    keeps memory and time linear for graphs far beyond what kamada-kawai can handle.
+    """
+    nodes = list(graph.nodes)
+    count = len(nodes)
+    if count == 0:
+        return {}
+    rng = np.random.default_rng(seed)
+    node_index = {node: i for i, node in enumerate(nodes)}
+    edges = np.asarray([(node_index[a], node_index[b]) for a, b in graph.edges], dtype=np.int64).reshape(-1, 2)
+
+    if pos is None:
+        p = rng.random((count, 2))
+    else:
+        p = np.asarray([pos[node] for node in nodes], dtype=np.float64)
+        p = (p - p.min(axis=0)) / max(np.ptp(p, axis=0).max(), 1e-9)
+    k = 1 / np.sqrt(count)
+    temperature = .1
+
+    for _ in range(iterations):
+        partners = rng.integers(count, size=(count, samples))
+        delta = p[:, None, :] - p[partners]
+        dist2 = np.maximum((delta ** 2).sum(axis=2), 1e-9)
+        disp = (delta * (k * k / dist2)[:, :, None]).sum(axis=1)
+
+        delta = p[edges[:, 0]] - p[edges[:, 1]]
+        pull = delta * (np.sqrt((delta ** 2).sum(axis=1)) / k)[:, None]
+        np.add.at(disp, edges[:, 0], -pull)
+        np.add.at(disp, edges[:, 1], pull)
+
+        length = np.maximum(np.sqrt((disp ** 2).sum(axis=1)), 1e-9)
+        p = p + disp * (np.minimum(length, temperature) / length)[:, None]
+        temperature = temperature * .95
+
+    return {node: p[i] for i, node in enumerate(nodes)}
+
+
+def region_graph_layout(graph: nx.Graph, grid: TriGrid = None):
+    """Layout for the region graph from build_graph: kamada-kawai when small, region centroids otherwise"""
+
+    def build():
+        if graph.number_of_nodes() <= SMALL_GRAPH:
+            return nx.kamada_kawai_layout(graph)
+        if grid is not None:
+            centroids = region_centroids(grid)
+            if all(isinstance(node, int) and 0 <= node < len(centroids) for node in graph.nodes):
+                return {node: centroids[node] for node in graph.nodes}
+        return sparse_force_layout(graph)
+
+    return layout_cache.get(graph, "region", build)
+
+
+def hex_graph_layout(hex_graph: nx.Graph, grid: TriGrid = None):
+    """Layout for the hex graph: kamada-kawai when small, position of each hex in the grid otherwise"""
+
+    def build():
+        if hex_graph.number_of_nodes() <= SMALL_GRAPH:
+            return nx.kamada_kawai_layout(hex_graph)
+        if grid is not None:
+            pos = {}
+            for node, hex_list in hex_graph.nodes(data="hex_list"):
+                if hex_list:
+                    x, y = hex_list[0]
+                    pos[node] = np.asarray(cell_xy(grid, x, y))
+            if len(pos) == hex_graph.number_of_nodes():
+                return pos
+        return sparse_force_layout(hex_graph)
+
+    return layout_cache.get(hex_graph, "hex", build)
@@ -1,16 +1,26 @@
+import logging
 import math
 import time
 import tkinter as tk
+import tkinter.filedialog
+import tkinter.messagebox
+import tkinter.ttk as ttk
 import re
-from PIL import Image, ImageTk, ImageDraw
+from PIL import ImageTk
 import matplotlib
 import matplotlib.pyplot as plt
 import networkx as nx
+import numpy as np
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 
 import grow as gr
+import layout
+import mapfile
+import portfolio
+import render
 import trigrid as tg
 import solve as sv
+import worker
 
 matplotlib.use("TkAgg")
 
@@ -19,16 +29,13 @@ color_palette = [color_palette[i // 5 + i % 5 * 8] for i in range(40)]
 four_color_palette = [(1, 0, 0), (0, 1, 0), (0, 0, 1), (1, 1, 0), (.9, .9, 1)]
 
 
-def color_convert(color):
-    # return f"#{int(255 * color[0]):02X}{int(255 * color[1]):02X}{int(255 * color[2]):02X}"
-    return int(255 * color[0]), int(255 * color[1]), int(255 * color[2])
-
-
 tri_grid = None
 graph_model = None
 three_id_hexes = None
 hex_graph = None
 coloring_solution = None
+grow_renderer = render.GridRenderer()
+current_task = None
 
 
 # The main window of the animation
@@ -84,6 +91,11 @@ def create_grow_controls(window):
     label = tk.Entry(input_row, state='readonly', textvariable=seed_text_rdonly)
     label.pack(side=tk.LEFT, padx=1)
 
+    engine_selection = tk.StringVar()
+    engine_selection.set(gr.ENGINES[0])
+    engine_menu = tk.OptionMenu(input_row, engine_selection, *gr.ENGINES)
+    engine_menu.pack(side=tk.LEFT, padx=3)
+
     def submit_action():
         if len(seed_input.get()) == 0:
             rnd_seed = math.floor(time.time() * 1000)
@@ -91,13 +103,19 @@ def create_grow_controls(window):
             rnd_seed = int(seed_input.get())
         seed_text_rdonly.set(str(rnd_seed))
 
-        grow_action(int(cell_count_input.get()), int(entity_count_input.get()), int(iter_limit_input.get()), rnd_seed)
+        grow_action(int(cell_count_input.get()), int(entity_count_input.get()), int(iter_limit_input.get()), rnd_seed,
+                    engine_selection.get())
 
     submit = tk.Button(input_row, text="grow",
                        command=submit_action)
 
     submit.pack(side=tk.RIGHT)
 
+    save = tk.Button(input_row, text="save", command=save_map_action)
+    save.pack(side=tk.RIGHT, padx=3)
+    load = tk.Button(input_row, text="load", command=load_map_action)
+    load.pack(side=tk.RIGHT, padx=3)
+
     input_row.pack(side=tk.TOP, fill=tk.X, padx=5, pady=5)
 
 
@@ -109,83 +127,26 @@ def create_grow_canvas(window):
 
 
 def render_grow_canvas(grid, hexes, canvas):
-    canvas.delete("all")
     width = canvas.winfo_width() - 4
     height = canvas.winfo_height() - 4
 
     print(f"Rendering grow canvas at ({width},{height})")
 
-    if coloring_solution is None:
-        colors = color_palette[0:grid.seed_count()]
-    else:
-        colors = []
-        for i in range(grid.seed_count()):
-            found = False
-            for c in range(len(coloring_solution)):
-                if i in coloring_solution[c]:
-                    colors.append(four_color_palette[c])
-                    found = True
-                    break
-
-            if not found:
-                colors.append(color_palette[i % len(color_palette)])
-
     if grid is None:
+        canvas.delete("all")
         return
 
-    canvas.pil_image = Image.new(mode="RGB", size=(width, height), color="black")
-    draw = ImageDraw.Draw(canvas.pil_image)
-
-    x_step = width / grid.height
-    y_step = height / grid.height
-    for j in range(grid.height):
-        x_start = width * ((grid.height - j) / (2 * grid.height))
-        for i in range(j * 2 + 1):
-            tri_cell = grid.get(i, j)
-            m = i % 2
-            if m == 0:
-                coords = [x_start + (i - 1) / 2 * x_step, (j + 1) * y_step, x_start + (i + 1) / 2 * x_step,
-                          (j + 1) * y_step, x_start + i / 2 * x_step, j * y_step]
-            else:
-                coords = [x_start + (i - 1) / 2 * x_step, j * y_step, x_start + (i + 1) / 2 * x_step, j * y_step,
-                          x_start + i / 2 * x_step, (j + 1) * y_step]
-
-            draw.polygon(coords, outline="grey" if x_step > 10 else None,
-                         fill='black' if tri_cell.id is None else color_convert(colors[tri_cell.id % len(colors)]))
-    # draw boundry between countries
-    for j in range(grid.height):
-        x_start = width * ((grid.height - j) / (2 * grid.height))
-        for i in range(1, j * 2 + 1, 2):
-            tri_cell = grid.get(i, j)
-            l, r, v = tri_cell.lrv()
-            if v is not None and v.id != tri_cell.id:
-                draw.line((x_start + (i - 1) / 2 * x_step, j * y_step, x_start + (i + 1) / 2 * x_step, j * y_step),
-                          fill="black")
-            if l is not None and l.id != tri_cell.id:
-                draw.line((x_start + (i - 1) / 2 * x_step, j * y_step, x_start + i / 2 * x_step, (j + 1) * y_step),
-                          fill="black")
-            if r is not None and r.id != tri_cell.id:
-                draw.line(
-                    (x_start + (i + 1) / 2 * x_step, j * y_step, x_start + i / 2 * x_step, (j + 1) * y_step),
-                    fill="black")
-
-    if hexes is not None:
-        for hex_top in hexes:
-            hex_top_x, hex_top_y = hex_top.xy()
-            x_start = width * ((grid.height -  hex_top_y) / (2 * grid.height))
-            y_start = hex_top_y * y_step
-            coords = [x_start + x_step * (hex_top_x - 1) / 2, y_start,
-                      x_start + x_step * (hex_top_x + 1) / 2, y_start,
-                      x_start + x_step * (hex_top_x + 2) / 2, y_start + y_step,
-                      x_start + x_step * (hex_top_x+ 1) / 2, y_start + 2 * y_step,
-                      x_start + x_step * (hex_top_x - 1) / 2, y_start + 2 * y_step,
-                      x_start + x_step * (hex_top_x- 2) / 2, y_start + y_step]
-            draw.polygon(coords, outline='white')
-            draw.text((x_start + x_step * (hex_top_x + 2) / 2, y_start + y_step),
-                      f"{hex_top.state[0]},{hex_top.state[1]},{hex_top.state[2]}", fill="white")
-
-    canvas.tk_image = ImageTk.PhotoImage(canvas.pil_image)
-    canvas.create_image((2, 2), anchor=tk.NW, image=canvas.tk_image)
+    lut = render.color_lut(max(grid.seed_count(), 1), color_palette, four_color_palette, coloring_solution)
+    canvas.pil_image = grow_renderer.render(grid, width, height, lut, hexes)
+
+    # Reuse the Tk image while the size is unchanged instead of recreating canvas items
+    tk_image = getattr(canvas, "tk_image", None)
+    if tk_image is not None and (tk_image.width(), tk_image.height()) == canvas.pil_image.size:
+        tk_image.paste(canvas.pil_image)
+    else:
+        canvas.delete("all")
+        canvas.tk_image = ImageTk.PhotoImage(canvas.pil_image)
+        canvas.create_image((2, 2), anchor=tk.NW, image=canvas.tk_image)
 
 
 def create_graph_controls(window):
@@ -204,7 +165,7 @@ def create_graph_controls(window):
 
     color_submit = tk.Button(input_row, text="Color", command=submit_action)
     color_submit.pack(side=tk.RIGHT, padx=3)
-    options = [x[9:] for x in filter(lambda a: a.startswith("coloring"), dir(sv))]
+    options = [x[9:] for x in filter(lambda a: a.startswith("coloring"), dir(sv))] + ["portfolio"]
     algo_selection.set(options[0])
     popup_menu = tk.OptionMenu(input_row, algo_selection, *options)
     popup_menu.pack(side=tk.RIGHT, padx=3)
@@ -220,35 +181,25 @@ def render_graph_canvas(graph, model, canvas):
     fig = canvas.figure
     fig.clear()
 
-    if coloring_solution is None:
-        colors = [color_palette[a % len(color_palette)] for a in range(len(graph.nodes))]
-    else:
-        colors = []
-        for i in range(len(graph.nodes)):
-            found = False
-            for c in range(len(coloring_solution)):
-                if i in coloring_solution[c]:
-                    colors.append(four_color_palette[c])
-                    found = True
-                    break
-
-            if not found:
-                colors.append(color_palette[i % len(color_palette)])
+    node_count = len(graph.nodes)
+    lut = render.color_lut(max(node_count, 1), color_palette, four_color_palette, coloring_solution)
+    colors = lut[np.asarray(graph.nodes, dtype=np.int64)] / 255
+    small = node_count <= layout.SMALL_GRAPH
 
     options = {
-        "node_size": 200,
+        "node_size": 200 if small else 10,
         "edgecolors": (.5, .5, .5, .5),
-        "linewidths": 3,
-        "width": 2,
+        "linewidths": 3 if small else 0,
+        "width": 2 if small else .5,
         "node_color": colors,
         "font_size": 7,
         "font_color": "black",
-        "with_labels": True,
+        "with_labels": small,
     }
 
     ax1 = fig.add_subplot()
 
-    nx.draw_kamada_kawai(graph, **options, ax=ax1)
+    nx.draw(graph, pos=layout.region_graph_layout(graph, model), **options, ax=ax1)
 
     plt.tight_layout(pad=.1)
     canvas.draw()
@@ -258,13 +209,16 @@ def render_hex_canvas(graph, canvas):
     fig = canvas.figure
     fig.clear()
 
-    pos = nx.kamada_kawai_layout(graph)
+    pos = layout.hex_graph_layout(graph, tri_grid)
+    small = len(graph.nodes) <= layout.SMALL_GRAPH
 
     ax2 = fig.add_subplot()
 
-    nx.draw_networkx_nodes(graph, pos, node_size=200, node_color=[(.85, .9, 1)], edgecolors=(.5, .5, .5, .5), ax=ax2)
-    nx.draw_networkx_edges(graph, pos, edge_color=(.5, .5, .5, .5), ax=ax2)
-    nx.draw_networkx_labels(graph, pos, font_size=6, ax=ax2)
+    nx.draw_networkx_nodes(graph, pos, node_size=200 if small else 10, node_color=[(.85, .9, 1)],
+                           edgecolors=(.5, .5, .5, .5), ax=ax2)
+    nx.draw_networkx_edges(graph, pos, edge_color=(.5, .5, .5, .5), width=1 if small else .5, ax=ax2)
+    if small:
+        nx.draw_networkx_labels(graph, pos, font_size=6, ax=ax2)
 
     plt.tight_layout(pad=.1)
     canvas.draw()
@@ -289,65 +243,217 @@ def create_graph_canvas(window):
     return canvas1, canvas2
 
 
-def grow_action(side_length, entity_count, iter_limit, seed):
-    global tri_grid
+def create_status_row(window):
+    global status_text
+    global progress_bar
+    global cancel_button
+
+    status_row = tk.Frame(window)
+    status_text = tk.StringVar()
+    status_text.set("Ready")
+
+    cancel_button = tk.Button(status_row, text="Cancel", command=cancel_action, state=tk.DISABLED)
+    cancel_button.pack(side=tk.RIGHT, padx=3)
+    progress_bar = ttk.Progressbar(status_row, orient=tk.HORIZONTAL, length=200, mode="determinate")
+    progress_bar.pack(side=tk.RIGHT, padx=3)
+    label = tk.Label(status_row, textvariable=status_text, anchor='w')
+    label.pack(side=tk.LEFT, padx=5, expand=True, fill=tk.X)
+
+    status_row.pack(side=tk.BOTTOM, fill=tk.X, padx=5, pady=2)
+
+
+def show_progress(task, done, total, message):
+    if total:
+        progress_bar["maximum"] = total
+        progress_bar["value"] = done
+    status_text.set(f"{task.name}: {message if message is not None else f'{done}/{total}'}")
+    cancel_button["state"] = tk.NORMAL if task.cancellable else tk.DISABLED
+
+
+def show_error(task, error):
+    progress_bar["value"] = 0
+    cancel_button["state"] = tk.DISABLED
+    if error is None:
+        status_text.set(f"{task.name} cancelled")
+    else:
+        status_text.set(f"{task.name} failed: {error}")
+
+
+def run_in_background(name, fn, on_done, cancellable=True):
+    # Only one stage runs at a time, its results are applied to the globals on the Tk thread by on_done.  Stages that
+    # never call progress pass cancellable=False, Cancel stays disabled while they run.
+    global current_task
+    if current_task is not None and current_task.is_running():
+        tk.messagebox.showinfo(title="Busy", message=f"Wait for {current_task.name} to finish or cancel it")
+        return
+
+    start = time.time()
+
+    def finish(result):
+        progress_bar["value"] = 0
+        cancel_button["state"] = tk.DISABLED
+        status_text.set(f"{name} finished in {time.time() - start:.2f}s")
+        on_done(result)
+
+    status_text.set(f"{name}...")
+    cancel_button["state"] = tk.NORMAL if cancellable else tk.DISABLED
+    current_task = worker.BackgroundTask(window, name, fn, finish, on_progress=show_progress, on_error=show_error,
+                                         cancellable=cancellable).start()
+
+
+def cancel_action():
+    if current_task is not None and current_task.is_running() and current_task.cancellable:
+        current_task.cancel()
+        status_text.set(f"Cancelling {current_task.name}...")
+
+
+def grow_action(side_length, entity_count, iter_limit, seed, engine="classic"):
+    def work(progress):
+        grid = tg.TriGrid(side_length)
+        gr.generate(entity_count, grid, iter_limit, seed, engine, progress=progress)
+        return grid
+
+    def done(grid):
+        global tri_grid
+        global graph_model
+        global three_id_hexes
+        global hex_graph
+        global coloring_solution
+
+        tri_grid = grid
+        graph_model = None
+        three_id_hexes = None
+        hex_graph = None
+        coloring_solution = None
+        render_grow_canvas(tri_grid, three_id_hexes, grow_canvas)
+
+    run_in_background("grow", work, done)
+
+
+def save_map_action():
+    if tri_grid is None:
+        tk.messagebox.showinfo(title="No map", message="Must grow or load a map before saving it")
+        return
+    path = tk.filedialog.asksaveasfilename(defaultextension=".trimap", filetypes=[("Map files", "*.trimap")])
+    if not path:
+        return
+    grid = tri_grid
+    hexes = three_id_hexes
+    coloring = coloring_solution
+    run_in_background("save", lambda progress: mapfile.save_map(path, grid, coloring, hexes), lambda result: None,
+                      cancellable=False)
+
+
+def load_map_action():
+    path = tk.filedialog.askopenfilename(filetypes=[("Map files", "*.trimap"), ("All files", "*")])
+    if not path:
+        return
+
+    def done(loaded):
+        global tri_grid
+        global graph_model
+        global three_id_hexes
+        global hex_graph
+        global coloring_solution
+
+        tri_grid = loaded.grid
+        graph_model = None
+        three_id_hexes = loaded.hexes
+        hex_graph = None
+        coloring_solution = loaded.coloring
+        render_grow_canvas(tri_grid, three_id_hexes, grow_canvas)
+
+    run_in_background("load", lambda progress: mapfile.load_map(path), done, cancellable=False)
+
+
+def build_missing_stages(grid, graph, hexes, linked_hexes, progress):
+    # Runs on the worker thread, only computes what the globals do not hold yet
+    if graph is None:
+        progress(0, 3, "building graph")
+        graph = sv.build_graph(grid)
+    if linked_hexes is None:
+        if hexes is None:
+            progress(1, 3, "finding hexes")
+            hexes = sv.find_3_color_hexes(grid)
+        progress(2, 3, "linking hexes")
+        linked_hexes = sv.find_two_color_linked_hex_graph(hexes)
+    return graph, hexes, linked_hexes
+
+
+def apply_stages(graph, hexes, linked_hexes):
     global graph_model
     global three_id_hexes
     global hex_graph
-    global coloring_solution
-
-    tri_grid = tg.TriGrid(side_length)
-    graph_model = None
-    three_id_hexes = None
-    hex_graph = None
-    coloring_solution = None
 
-    gr.generate(entity_count, tri_grid, iter_limit, seed)
-    render_grow_canvas(tri_grid, three_id_hexes, grow_canvas)
+    if graph is not graph_model:
+        graph_model = graph
+        render_graph_canvas(graph_model, tri_grid, graph_canvas)
+    if linked_hexes is not hex_graph:
+        three_id_hexes = hexes
+        hex_graph = linked_hexes
+        render_grow_canvas(tri_grid, three_id_hexes, grow_canvas)
+        render_hex_canvas(hex_graph, hex_canvas)
 
 
 def graph_action():
-    global tri_grid
-    global graph_model
     if tri_grid is None:
         tk.messagebox.showinfo(title="Graph not ready", message="Must grow a map before converting to graph")
         return
-    graph_model = sv.build_graph(tri_grid)
-    render_graph_canvas(graph_model, tri_grid, graph_canvas)
+    grid = tri_grid
+    run_in_background("graph", lambda progress: sv.build_graph(grid),
+                      lambda graph: apply_stages(graph, three_id_hexes, hex_graph), cancellable=False)
 
 
 def hex_action():
-    global tri_grid
-    global graph_model
-    global three_id_hexes
-    global hex_graph
-    if graph_model is None:
-        graph_action()
-    three_id_hexes = sv.find_3_color_hexes(tri_grid)
-    render_grow_canvas(tri_grid, three_id_hexes, grow_canvas)
+    if tri_grid is None:
+        tk.messagebox.showinfo(title="Graph not ready", message="Must grow a map before converting to graph")
+        return
+    grid = tri_grid
+    graph = graph_model
 
-    hex_graph = sv.find_two_color_linked_hex_graph(three_id_hexes)
-    render_hex_canvas(hex_graph, hex_canvas)
+    run_in_background("hexes", lambda progress: build_missing_stages(grid, graph, None, None, progress),
+                      lambda stages: apply_stages(*stages))
 
 
 def color_action(algo_name: str):
-    global tri_grid
-    global graph_model
-    global three_id_hexes
-    global hex_graph
-    global coloring_solution
-    if hex_graph is None:
-        hex_action()
-
-    coloring_solution = eval("sv.coloring_" + algo_name + "(tri_grid,hex_graph)")
-
-    render_grow_canvas(tri_grid, three_id_hexes, grow_canvas)
-    render_graph_canvas(graph_model, tri_grid, graph_canvas)
+    if tri_grid is None:
+        tk.messagebox.showinfo(title="Graph not ready", message="Must grow a map before converting to graph")
+        return
+    grid = tri_grid
+    stages = (graph_model, three_id_hexes, hex_graph)
+    if algo_name == "portfolio":
+        coloring = None
+    else:
+        coloring = getattr(sv, "coloring_" + algo_name)
+
+    def work(progress):
+        graph, hexes, linked_hexes = build_missing_stages(grid, *stages, progress)
+        # The portfolio reports every finished run and can stop there, the single solvers run to the end
+        progress(3, 4, "coloring " + algo_name, cancellable=coloring is None)
+        if coloring is None:
+            return graph, hexes, linked_hexes, portfolio.solve_portfolio(grid, linked_hexes, progress=progress)["cmap"]
+        return graph, hexes, linked_hexes, coloring(grid, linked_hexes)
+
+    def done(result):
+        global coloring_solution
+        coloring_solution = result[3]
+        # apply_stages renders the canvases of new stages, the others only need the new coloring drawn
+        graph_rendered = result[0] is not graph_model
+        hexes_rendered = result[2] is not hex_graph
+        apply_stages(*result[:3])
+        if not hexes_rendered:
+            render_grow_canvas(tri_grid, three_id_hexes, grow_canvas)
+        if not graph_rendered:
+            render_graph_canvas(graph_model, tri_grid, graph_canvas)
+
+    run_in_background("color " + algo_name, work, done)
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     print("Initializing application")
     window = create_main_window()
+    create_status_row(window)
     grow_frame = tk.LabelFrame(window, text="Generation")
     grow_frame.pack(side=tk.TOP, padx=3, pady=3, expand=True, fill=tk.BOTH)
     create_grow_controls(grow_frame)
@@ -0,0 +1,135 @@
+"""Binary map files: a grown TriGrid plus optional coloring and hexes, loaded by memory-mapping.
+
+Layout (all little endian):
+
+    magic    8 bytes  b"TRIMAP\\x00\\x01"
+    length   uint64   size of the JSON header that follows
+    header   JSON     height, up, seed_count, free form metadata and a section table
+    padding           up to a multiple of ALIGN bytes, where the data starts
+    sections          raw C-order arrays, each starting at a multiple of ALIGN bytes from the data start
+
+Sections are "ids" (the full (height, 2 * height - 1) int32 storage of the root grid, padding included),
+"colors" (int8 color per region, -1 when uncolored, 4 for overflow), "hex_positions" and "hex_triples".  Loading
+maps the sections with np.memmap instead of reading them, so opening a map costs a few page faults regardless of
+its size.
+"""
+import json
+import os
+import struct
+
+import numpy as np
+
+from solve import HexList
+from trigrid import TriGrid, ID_DTYPE
+
+MAGIC = b"TRIMAP\x00\x01"
+ALIGN = 64
+COLOR_COUNT = 4
+
+
+def _aligned(offset: int) -> int:
+    return -(-offset // ALIGN) * ALIGN
+
+
+class LoadedMap:
+    """Contents of a map file: grid (a root TriGrid over the mapped ids), coloring (cmap tuple of 5 id lists or
+    None), hexes (HexList or None) and the metadata dict given when saving"""
+
+    def __init__(self, grid: TriGrid, coloring, hexes: HexList, metadata: dict):
+        self.grid = grid
+        self.coloring = coloring
+        self.hexes = hexes
+        self.metadata = metadata
+
+
+def coloring_to_colors(cmap, region_count: int) -> np.ndarray:
+    colors = np.full(region_count, -1, dtype=np.int8)
+    for color, ids in enumerate(cmap):
+        colors[np.asarray(ids, dtype=np.int64)] = color
+    return colors
+
+
+def colors_to_coloring(colors: np.ndarray):
+    order = np.argsort(colors, kind="stable")
+    bounds = np.searchsorted(colors[order], np.arange(COLOR_COUNT + 2))
+    return tuple(order[bounds[c]:bounds[c + 1]].tolist() for c in range(COLOR_COUNT + 1))
+
+
+def save_map(path, grid: TriGrid, coloring=None, hexes: HexList = None, metadata: dict = None):
+    """Write the root of grid, with the cmap from a coloring_* function and the hexes from find_3_color_hexes.
+
+    The file is written next to path and then renamed over it, so a map that is currently loaded from path stays
+    valid.
+    """
+    root = grid.root
+    arrays = {"ids": np.ascontiguousarray(root.ids, dtype=ID_DTYPE)}
+    if coloring is not None:
+        region_count = max(root.seed_count(), max((max(ids, default=-1) for ids in coloring), default=-1) + 1)
+        arrays["colors"] = coloring_to_colors(coloring, region_count)
+    if hexes is not None:
+        arrays["hex_positions"] = np.ascontiguousarray(hexes.positions, dtype="<i8")
+        arrays["hex_triples"] = np.ascontiguousarray(hexes.triples, dtype="<i8")
+
+    sections = {}
+    offset = 0
+    for name, array in arrays.items():
+        sections[name] = {"offset": offset, "dtype": array.dtype.newbyteorder("<").str, "shape": list(array.shape)}
+        offset = _aligned(offset + array.nbytes)
+
+    header = json.dumps({
+        "height": root.height,
+        "up": root.up,
+        "seed_count": root.seed_count(),
+        "metadata": metadata or {},
+        "sections": sections,
+    }).encode()
+    data_start = _aligned(len(MAGIC) + 8 + len(header))
+
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as out:
+        out.write(MAGIC)
+        out.write(struct.pack("<Q", len(header)))
+        out.write(header)
+        for name, array in arrays.items():
+            out.write(b"\0" * (data_start + sections[name]["offset"] - out.tell()))
+            array.astype(sections[name]["dtype"], copy=False).tofile(out)
+    os.replace(temp_path, path)
+
+
+def read_header(path) -> (dict, int):
+    """JSON header of a map file and the file offset where its data starts"""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a map file")
+        (length,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(length))
+    return header, _aligned(len(MAGIC) + 8 + length)
+
+
+def load_map(path, mode="c") -> LoadedMap:
+    """Map a file saved by save_map.
+
+    mode is the np.memmap mode: "c" (default) keeps writes to the grid in memory only, "r" makes the ids read only
+    and "r+" writes changes back to the file.
+    """
+    header, data_start = read_header(path)
+    sections = header["sections"]
+
+    def section(name):
+        entry = sections.get(name)
+        if entry is None:
+            return None
+        shape = tuple(entry["shape"])
+        if 0 in shape:
+            return np.zeros(shape, dtype=entry["dtype"])
+        return np.memmap(path, dtype=entry["dtype"], mode=mode, offset=data_start + entry["offset"], shape=shape)
+
+    grid = TriGrid(header["height"], up=header["up"], ids=section("ids"))
+    grid._seed_count = header["seed_count"]
+    grid._seeds_ = list(range(header["seed_count"]))
+
+    colors = section("colors")
+    coloring = None if colors is None else colors_to_coloring(np.asarray(colors))
+    positions = section("hex_positions")
+    hexes = None if positions is None else HexList(positions, section("hex_triples"))
+    return LoadedMap(grid, coloring, hexes, header["metadata"])
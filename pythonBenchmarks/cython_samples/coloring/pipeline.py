@@ -0,0 +1,150 @@
+"""Headless grow -> graph -> hexes -> color pipeline.
+
+Runs every (side, entity count, seed) combination on a process pool and writes one JSON line per map with the
+stage timings, stage counters and the outcome of every coloring algorithm.  Never imports tkinter/matplotlib.
+Maps can be saved as map files (see mapfile.py) and later re-colored from those files without growing them again.
+
+    python pipeline.py --sides 100 200 --entities 12 50 --seeds 0-99 --algos simple dsatur --out sweep.jsonl
+    python pipeline.py --sides 2000 --entities 100000 --engine batch --algos dsatur --save-dir maps
+    python pipeline.py --maps maps/*.trimap --algos recursive_triangulation
+"""
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+import grow as gr
+import mapfile
+import solve as sv
+import tracing
+import trigrid as tg
+
+
+def available_algorithms():
+    return [x[9:] for x in filter(lambda a: a.startswith("coloring_"), dir(sv))]
+
+
+def parse_int_list(values):
+    # Accepts plain integers and inclusive ranges such as 0-99
+    out = []
+    for value in values:
+        if "-" in value[1:]:
+            first, last = value[1:].split("-", 1)
+            out.extend(range(int(value[0] + first), int(last) + 1))
+        else:
+            out.append(int(value))
+    return out
+
+
+def run_job(job):
+    # job is (side, entity_count, seed, engine, algos, save_dir, map_path), map_path replaces growing the map
+    side, entity_count, seed, engine, algos, save_dir, map_path = job
+    timings = {}
+
+    def timed(stage, fn, *args, **kwargs):
+        start = time.time()
+        out = fn(*args, **kwargs)
+        timings[stage] = time.time() - start
+        return out
+
+    tracing.reset()
+    if map_path is None:
+        grid = tg.TriGrid(side)
+        timed("grow", gr.generate, entity_count, grid, 0, seed, engine)
+        hexes = None
+    else:
+        loaded = timed("load", mapfile.load_map, map_path)
+        grid = loaded.grid
+        hexes = loaded.hexes
+        side = grid.height
+        entity_count = loaded.metadata.get("entity_count", grid.seed_count())
+        seed = loaded.metadata.get("seed")
+        engine = loaded.metadata.get("engine")
+    result = {"side": side, "entity_count": entity_count, "seed": seed, "engine": engine, "timings": timings}
+    if map_path is not None:
+        result["map"] = map_path
+
+    graph = timed("graph", sv.build_graph, grid)
+    if hexes is None:
+        hexes = timed("hexes", sv.find_3_color_hexes, grid)
+    hex_graph = timed("hex_graph", sv.find_two_color_linked_hex_graph, hexes)
+
+    result["regions"] = graph.number_of_nodes()
+    result["borders"] = graph.number_of_edges()
+    result["hexes"] = hex_graph.number_of_nodes()
+    result["colorings"] = {}
+    best = None
+    for algo in algos:
+        start = time.time()
+        try:
+            cmap = getattr(sv, "coloring_" + algo)(grid, hex_graph)
+            outcome = sv.score_coloring(grid, cmap)
+            rank = (outcome["overflow"], outcome["conflicts"], outcome["uncolored"])
+            if best is None or rank < best[0]:
+                best = (rank, cmap)
+        except Exception as e:
+            outcome = {"error": f"{type(e).__name__}: {e}"}
+        outcome["seconds"] = time.time() - start
+        result["colorings"][algo] = outcome
+    result["counters"] = tracing.report()
+
+    if save_dir is not None:
+        result["map"] = os.path.join(save_dir, f"map_{side}_{entity_count}_{seed}.trimap")
+        timed("save", mapfile.save_map, result["map"], grid, None if best is None else best[1], hexes,
+              {"entity_count": entity_count, "seed": seed, "engine": engine})
+
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sweep grow/graph/hex/color over many maps without the GUI")
+    parser.add_argument("--sides", nargs="+", default=["100"], help="grid side counts (ranges like 50-60 allowed)")
+    parser.add_argument("--entities", nargs="+", default=["12"], help="entity counts per map")
+    parser.add_argument("--seeds", nargs="+", default=["0"], help="random seeds, negative seeds use bordered maps")
+    parser.add_argument("--algos", nargs="+", default=None, choices=available_algorithms(),
+                        help="coloring algorithms to run (default: all)")
+    parser.add_argument("--engine", default="classic", choices=gr.ENGINES, help="grow engine")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--maps", nargs="+", default=None,
+                        help="map files to color instead of growing --sides/--entities/--seeds maps")
+    parser.add_argument("--save-dir", default=None, help="save every map, its hexes and best coloring here")
+    parser.add_argument("--out", default="pipeline_results.jsonl", help="JSON lines output file")
+    parser.add_argument("-v", "--verbose", action="count", default=0,
+                        help="log stage summaries (-v) or full per step traces (-vv) on stderr")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=(logging.WARNING, logging.INFO, logging.DEBUG)[min(args.verbose, 2)],
+                        format="%(processName)s %(message)s")
+
+    algos = args.algos if args.algos is not None else available_algorithms()
+    if args.save_dir is not None:
+        os.makedirs(args.save_dir, exist_ok=True)
+    if args.maps is not None:
+        jobs = [(None, None, None, None, algos, args.save_dir, path) for path in args.maps]
+    else:
+        jobs = [(side, entity_count, seed, args.engine, algos, args.save_dir, None) for side, entity_count, seed in
+                itertools.product(parse_int_list(args.sides), parse_int_list(args.entities),
+                                  parse_int_list(args.seeds))]
+
+    print(f"Running {len(jobs)} maps x {len(algos)} algorithms on {args.processes} processes")
+    start = time.time()
+    failures = {algo: 0 for algo in algos}
+    with open(args.out, "w") as out, multiprocessing.Pool(processes=args.processes) as pool:
+        for done, result in enumerate(pool.imap_unordered(run_job, jobs), 1):
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+            for algo, outcome in result["colorings"].items():
+                if "error" in outcome or outcome["overflow"] or outcome["conflicts"] or outcome["uncolored"]:
+                    failures[algo] = failures[algo] + 1
+            print(f"[{done}/{len(jobs)}] side={result['side']} entities={result['entity_count']} "
+                  f"seed={result['seed']} in {sum(result['timings'].values()):.3f}s")
+
+    print(f"total time = {time.time() - start} seconds")
+    for algo, count in failures.items():
+        print(f"{algo}: {count}/{len(jobs)} maps not fully 4-colored")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+import functools
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from trigrid import TriGrid, NO_CELL
+
+BLACK = (0, 0, 0)
+GREY = (128, 128, 128)
+
+
+def to_rgb(color):
+    return int(255 * color[0]), int(255 * color[1]), int(255 * color[2])
+
+
+@functools.lru_cache(maxsize=8)
+def pixel_cell_index(width: int, height: int, grid_height: int) -> np.ndarray:
+    """Flat storage index of the triangle under every pixel of a width x height image of an up grid (-1 outside).
+
+    Row j of the grid spans y_step pixels.  Measured in half x_steps from the row start, the edge between cells
+    i and i + 1 lies at i + fy for even i and at i + 1 - fy for odd i, fy being the pixel's fraction down the row.
+    """
+    x_step = width / grid_height
+    y_step = height / grid_height
+    py = (np.arange(height) + .5)[:, None]
+    px = (np.arange(width) + .5)[None, :]
+
+    j = np.floor(py / y_step).astype(np.int64)
+    fy = py / y_step - j
+    x_start = width * ((grid_height - j) / (2 * grid_height))
+    s = (px - x_start) / (x_step / 2)
+    q = np.floor((s + fy) / 2).astype(np.int64)
+    i = np.where(s < 2 * q + fy, 2 * q, 2 * q + 1)
+
+    inside = (j < grid_height) & (i >= 0) & (i <= 2 * j)
+    index = np.where(inside, j * (2 * grid_height - 1) + i, -1)
+    index.setflags(write=False)
+    return index
+
+
+def color_lut(count: int, palette, solution_palette, coloring_solution=None) -> np.ndarray:
+    """RGB row per id: palette colors by id, replaced by solution_palette[c] for ids in coloring_solution[c]"""
+    palette = np.asarray([to_rgb(c) for c in palette], dtype=np.uint8)
+    lut = palette[np.arange(count) % len(palette)]
+    if coloring_solution is not None:
+        for c, ids in enumerate(coloring_solution):
+            ids = np.asarray(ids, dtype=np.int64)
+            lut[ids[ids < count]] = to_rgb(solution_palette[c])
+    return lut
+
+
+def border_mask(values: np.ndarray) -> np.ndarray:
+    """Pixels whose value differs from the pixel to their right or below"""
+    mask = np.zeros(values.shape, dtype=bool)
+    mask[:, :-1] |= values[:, :-1] != values[:, 1:]
+    mask[:-1, :] |= values[:-1, :] != values[1:, :]
+    return mask
+
+
+def region_pixels(grid: TriGrid, index: np.ndarray) -> np.ndarray:
+    inside = index >= 0
+    region = np.full(index.shape, NO_CELL, dtype=np.int64)
+    region[inside] = grid.ids.reshape(-1)[index[inside]]
+    return region
+
+
+def shade(region: np.ndarray, index: np.ndarray, lut: np.ndarray, outlines: bool) -> np.ndarray:
+    """Pixels for region ids: lut colors, grey cell outlines (optional) and black region borders"""
+    pixels = np.zeros(region.shape + (3,), dtype=np.uint8)
+    assigned = region >= 0
+    pixels[assigned] = lut[region[assigned] % len(lut)]
+    if outlines:
+        pixels[border_mask(index) & (index >= 0)] = GREY
+    pixels[border_mask(region) & assigned] = BLACK
+    return pixels
+
+
+def render_pixels(grid: TriGrid, width: int, height: int, lut: np.ndarray) -> np.ndarray:
+    index = pixel_cell_index(width, height, grid.height)
+    return shade(region_pixels(grid, index), index, lut, width / grid.height > 10)
+
+
+def draw_hexes(image: Image.Image, grid: TriGrid, hexes):
+    # hexes is the HexList from solve.find_3_color_hexes
+    draw = ImageDraw.Draw(image)
+    width, height = image.size
+    x_step = width / grid.height
+    y_step = height / grid.height
+    for (hex_top_x, hex_top_y), ids in zip(hexes.positions.tolist(), hexes.triples.tolist()):
+        x_start = width * ((grid.height - hex_top_y) / (2 * grid.height))
+        y_start = hex_top_y * y_step
+        coords = [x_start + x_step * (hex_top_x - 1) / 2, y_start,
+                  x_start + x_step * (hex_top_x + 1) / 2, y_start,
+                  x_start + x_step * (hex_top_x + 2) / 2, y_start + y_step,
+                  x_start + x_step * (hex_top_x + 1) / 2, y_start + 2 * y_step,
+                  x_start + x_step * (hex_top_x - 1) / 2, y_start + 2 * y_step,
+                  x_start + x_step * (hex_top_x - 2) / 2, y_start + y_step]
+        draw.polygon(coords, outline='white')
+        draw.text((x_start + x_step * (hex_top_x + 2) / 2, y_start + y_step), f"{ids[0]},{ids[1]},{ids[2]}",
+                  fill="white")
+
+
+def render_image(grid: TriGrid, width: int, height: int, lut: np.ndarray, hexes=None) -> Image.Image:
+    image = Image.fromarray(render_pixels(grid, width, height, lut), mode="RGB")
+    if hexes is not None:
+        draw_hexes(image, grid, hexes)
+    return image
+
+
+class GridRenderer:
+    """Keeps the last rendered image of a grid and repaints only the pixels of cells whose id or color changed.
+
+    The full image is rebuilt when the grid, its height or the image size changes.  Otherwise the pixel region
+    ids are refreshed when the grid ids changed (TriGrid.mark_changed) and compared with the previous frame, and
+    pixels of ids whose lut entry changed are added.  Dirty pixels plus a one pixel margin, for the borders, are
+    repainted inside their bounding box.
+    """
+
+    def __init__(self):
+        self._key = None
+        self._version = None
+        self._lut = None
+        self._index = None
+        self._region = None
+        self._pixels = None
+        self.last_dirty_box = None
+
+    def _paint(self, grid, lut, y0, y1, x0, x1):
+        # Repaint [y0, y1) x [x0, x1), borders need one extra pixel to the right and below
+        y_end = min(y1 + 1, self._region.shape[0])
+        x_end = min(x1 + 1, self._region.shape[1])
+        pixels = shade(self._region[y0:y_end, x0:x_end], self._index[y0:y_end, x0:x_end], lut,
+                       self._region.shape[1] / grid.height > 10)
+        self._pixels[y0:y1, x0:x1] = pixels[:y1 - y0, :x1 - x0]
+
+    def render(self, grid: TriGrid, width: int, height: int, lut: np.ndarray, hexes=None) -> Image.Image:
+        # Holding the root itself (not its id()) so a new grid can never be mistaken for the previous one
+        key = (grid.root, grid.height, width, height)
+        rebuild = self._key is None or key[0] is not self._key[0] or key[1:] != self._key[1:]
+        if rebuild or len(lut) != len(self._lut):
+            self._key = key
+            self._index = pixel_cell_index(width, height, grid.height)
+            self._region = region_pixels(grid, self._index)
+            self._pixels = np.zeros((height, width, 3), dtype=np.uint8)
+            self._paint(grid, lut, 0, height, 0, width)
+            self.last_dirty_box = (0, height, 0, width)
+        else:
+            dirty = np.zeros((height, width), dtype=bool)
+            if grid.root._version != self._version:
+                region = region_pixels(grid, self._index)
+                dirty |= region != self._region
+                self._region = region
+            changed_ids = np.flatnonzero((lut != self._lut).any(axis=1))
+            if changed_ids.size > 0:
+                dirty |= np.isin(self._region % len(lut), changed_ids) & (self._region >= 0)
+
+            rows = np.flatnonzero(dirty.any(axis=1))
+            if rows.size > 0:
+                cols = np.flatnonzero(dirty.any(axis=0))
+                self.last_dirty_box = (max(int(rows[0]) - 1, 0), int(rows[-1]) + 1,
+                                       max(int(cols[0]) - 1, 0), int(cols[-1]) + 1)
+                self._paint(grid, lut, *self.last_dirty_box)
+            else:
+                self.last_dirty_box = None
+
+        self._version = grid.root._version
+        self._lut = lut.copy()
+        image = Image.fromarray(self._pixels, mode="RGB")
+        if hexes is not None:
+            draw_hexes(image, grid, hexes)
+        return image
@@ -1,8 +1,15 @@
-import sys
+import heapq
+import itertools
+import multiprocessing
+import random
 
 import networkx as nx
+import numpy as np
 
-from trigrid import TriGrid, TriCell
+import tracing
+from dsatur import dsatur_color, UNCOLORED
+from tracing import log
+from trigrid import TriGrid
 
 
 def build_graph(grid: TriGrid):
@@ -13,13 +20,8 @@ def build_graph(grid: TriGrid):
 
     graph.add_nodes_from(range(seed_count))
 
-    for seed_id in range(seed_count):
-        adj_ids = grid.find_adjacent_ids(seed_id)
-        for adj_id in adj_ids:
-            if adj_id is None:
-                continue
-            if adj_id > seed_id:
-                graph.add_edge(seed_id, adj_id)
+    edge_a, edge_b = grid.region_index().edges()
+    graph.add_edges_from(zip(edge_a.tolist(), edge_b.tolist()))
 
     return graph
 
@@ -61,71 +63,142 @@ def directional_color_map(grid: TriGrid):
     return mapping
 
 
-def find_3_color_hexes(grid: TriGrid):
-    hexes = []
-    triangles = grid.triangles()
-    for triangle in triangles:
-        if triangle.xy()[0] % 2 == 0:
-            continue
-        hex_triangles = [triangle._l, triangle._r]
-        if None in hex_triangles:
-            continue
-        hex_triangles.append(triangle._l._v)
-        hex_triangles.append(triangle._r._v)
-        if None in hex_triangles:
-            continue
-        hex_triangles.append(triangle._l._v._r)
-        ids = [triangle.id]
-        for hex_triangle in hex_triangles:
-            if hex_triangle.id not in ids:
-                ids.append(hex_triangle.id)
-
-        if len(ids) == 3:
-            hexes.append(triangle)
-            ids.sort()
-            triangle.state = ids
-            print(f"[{ids[0]},{ids[1]},{ids[2]}]" + str(triangle) + "V" + " ".join(str(ht) for ht in hex_triangles))
+# Cells per chunk of rows scanned at once by find_3_color_hexes
+HEX_CHUNK_CELLS = 1 << 20
 
-    return hexes
 
+class HexList:
+    """Hexes found by find_3_color_hexes.
 
-def find_two_color_linked_hex_graph(three_id_hexes):
-    unique_triples = {}
-    pair_match_map = {}
-    graph = nx.Graph()
+    positions is an (n, 2) array of the root (x, y) of each hex's centre triangle (the odd x triangle of its first
+    row) and triples the (n, 3) array of the sorted ids of its three regions, in row order.
+    """
 
-    for hex in three_id_hexes:
-        triplet = (hex.state[0], hex.state[1], hex.state[2])
+    def __init__(self, positions: np.ndarray, triples: np.ndarray):
+        self.positions = positions
+        self.triples = triples
 
-        out = unique_triples.get(triplet)
-        if out is None:
-            unique_triples[triplet] = [hex]
-        else:
-            out.append(hex)
-            print(f"Dropping duplicate hex [{out}]<{hex}>")
-            continue
+    def __len__(self):
+        return len(self.positions)
 
-        pairs = ((triplet[0], triplet[1]), (triplet[0], triplet[2]), (triplet[1], triplet[2]))
+    def __repr__(self):
+        return f"HexList({len(self)} hexes)"
+
+
+def find_3_color_hexes(grid: TriGrid) -> HexList:
+    """Hexes of six triangles covering exactly three assigned ids.
+
+    The hex around odd x in row y is (x - 1, y), (x, y), (x + 1, y) plus (x, y'), (x + 1, y'), (x + 2, y') of the
+    next row away from the tip (y' = y + 1 in an up grid, y - 1 in a down grid), all in root coordinates.  Every
+    centre of a chunk of rows is tested at once on shifted slices of the id array.
+    """
+    counters = tracing.stage("find_3_color_hexes")
+    root = grid.root
+    ids = root.ids
+    height, width = ids.shape
+    centre_mask = grid.cell_mask()
+    dy = 1 if root.up else -1
+    y_first, y_end = (0, height - 1) if root.up else (1, height)
+    # Centres x = 1, 3, ... keep x + 2 of the next row inside the storage
+    centre_count = max((width - 3) // 2, 0)
+    chunk_rows = max(1, HEX_CHUNK_CELLS // width)
+
+    def columns(rows, shift):
+        return rows[:, 1 + shift:1 + shift + 2 * centre_count:2]
+
+    positions = []
+    triples = []
+    for y0 in range(y_first, y_end, chunk_rows):
+        y1 = min(y0 + chunk_rows, y_end)
+        row = ids[y0:y1]
+        next_row = ids[y0 + dy:y1 + dy]
+        hexes = np.stack((columns(row, -1), columns(row, 0), columns(row, 1),
+                          columns(next_row, 0), columns(next_row, 1), columns(next_row, 2)), axis=-1)
+        hexes.sort(axis=-1)
+        distinct = 1 + np.count_nonzero(hexes[..., 1:] != hexes[..., :-1], axis=-1)
+        found = (distinct == 3) & (hexes[..., 0] >= 0) & columns(centre_mask[y0:y1], 0)
+        hy, hx = np.nonzero(found)
+        hexes = hexes[hy, hx]
+        middle = hexes[np.arange(len(hexes)), np.argmax(hexes != hexes[:, :1], axis=1)]
+        positions.append(np.stack((2 * hx + 1, hy + y0), axis=1))
+        triples.append(np.stack((hexes[:, 0], middle, hexes[:, -1]), axis=1))
+
+    if not positions:
+        hexes = HexList(np.zeros((0, 2), dtype=np.int64), np.zeros((0, 3), dtype=np.int64))
+    else:
+        hexes = HexList(np.concatenate(positions).astype(np.int64), np.concatenate(triples).astype(np.int64))
+    counters.finish(hexes=len(hexes))
+    return hexes
 
-        for pair in pairs:
-            out = pair_match_map.get(pair)
-            if out is None:
-                pair_match_map[pair] = [triplet]
-            else:
-                out.append(triplet)
 
-    for (triplet, hex_list) in unique_triples.items():
-        graph.add_node(triplet, hex_list=hex_list)
+def find_two_color_linked_hex_graph(three_id_hexes: HexList):
+    """Graph of the distinct id triples of the hexes, linked when two triples share a pair of ids.
 
-    for pair, triplets in pair_match_map.items():
-        for i in range(len(triplets)):
-            for j in range(i + 1, len(triplets)):
-                graph.add_edge(triplets[i], triplets[j], pair=pair)
+    Nodes are id triples with the positions of their hexes as hex_list, edges carry the shared pair.
+    """
+    counters = tracing.stage("find_two_color_linked_hex_graph")
+    graph = nx.Graph()
+    if len(three_id_hexes) == 0:
+        counters.finish()
+        return graph
 
+    triples, first_hex, hex_triple = np.unique(three_id_hexes.triples, axis=0, return_index=True,
+                                               return_inverse=True)
+    hex_triple = hex_triple.reshape(-1)
+    # Number the triples in order of their first hex
+    order = np.argsort(first_hex, kind="stable")
+    triples = triples[order]
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    hex_triple = rank[hex_triple]
+    counters.add("duplicates", len(hex_triple) - len(triples))
+
+    hex_order = np.argsort(hex_triple, kind="stable")
+    hex_ptr = np.searchsorted(hex_triple[hex_order], np.arange(len(triples) + 1))
+    positions = three_id_hexes.positions[hex_order].tolist()
+    triple_list = [tuple(triple) for triple in triples.tolist()]
+    graph.add_nodes_from((triple_list[t], {"hex_list": [tuple(p) for p in positions[hex_ptr[t]:hex_ptr[t + 1]]]})
+                         for t in range(len(triple_list)))
+
+    # Pair index: (a, b), (a, c), (b, c) of every triple, grouped by pair in order of first appearance
+    pairs = triples[:, [0, 1, 0, 2, 1, 2]].reshape(-1, 2)
+    pair_triple = np.repeat(np.arange(len(triples)), 3)
+    _, first_pair, pair_group = np.unique(pairs, axis=0, return_index=True, return_inverse=True)
+    group_rank = np.empty_like(first_pair)
+    group_rank[np.argsort(first_pair, kind="stable")] = np.arange(len(first_pair))
+    pair_group = group_rank[pair_group.reshape(-1)]
+    pair_order = np.argsort(pair_group, kind="stable")
+    pair_group = pair_group[pair_order]
+
+    # Every two entries of a group are linked, taken as (i, j) with i < j positions in the grouped order
+    edge_i = []
+    edge_j = []
+    distance = 1
+    while distance < len(pair_group):
+        same = np.flatnonzero(pair_group[distance:] == pair_group[:-distance])
+        if same.size == 0:
+            break
+        edge_i.append(same)
+        edge_j.append(same + distance)
+        distance = distance + 1
+    if edge_i:
+        edge_i = np.concatenate(edge_i)
+        edge_j = np.concatenate(edge_j)
+        edge_order = np.lexsort((edge_j, edge_i))
+        edge_i = edge_i[edge_order]
+        edge_j = edge_j[edge_order]
+        tri_a = pair_triple[pair_order[edge_i]].tolist()
+        tri_b = pair_triple[pair_order[edge_j]].tolist()
+        edge_pairs = pairs[pair_order[edge_i]].tolist()
+        graph.add_edges_from((triple_list[a], triple_list[b], {"pair": tuple(pair)})
+                             for a, b, pair in zip(tri_a, tri_b, edge_pairs))
+
+    counters.finish(nodes=graph.number_of_nodes(), edges=graph.number_of_edges())
     return graph
 
 
-def depth_greedy_traverse_hex(hex_graph: nx.Graph, start_hexes: []):
+def depth_greedy_traverse_hex(hex_graph: nx.Graph, start_hexes: [], rng: random.Random = None):
+    # rng shuffles the order in which neighbors are stacked, None keeps the graph order
     traversed_set = {}
     depth_stack = start_hexes
 
@@ -134,7 +207,10 @@ def depth_greedy_traverse_hex(hex_graph: nx.Graph, start_hexes: []):
         if current_hex in traversed_set:
             continue
         traversed_set[current_hex] = True
-        for next_hex in hex_graph.neighbors(current_hex):
+        next_hexes = list(hex_graph.neighbors(current_hex))
+        if rng is not None:
+            rng.shuffle(next_hexes)
+        for next_hex in next_hexes:
             if next_hex not in traversed_set:
                 depth_stack.append(next_hex)
         yield current_hex
@@ -163,10 +239,19 @@ def build_min_connected_nodes(hex_graph: nx.Graph) -> list:
 
 
 class ColorMap:
-    def __init__(self):
+    """Assignment of ids to the four colors plus an overflow slot for ids that could not be colored.
+
+    cmap is the tuple of per-color id lists.  Every id also has its color and position within that list recorded
+    in flat arrays, so find/add/remove are O(1) per id (removal swaps the last list entry into the freed slot).
+    """
+    _NO_COLOR = -1
+
+    def __init__(self, size: int = 0):
         self.cmap = ([], [], [], [], [])
         self.color_count = 4
         self._empty = True
+        self._color_of = [self._NO_COLOR] * size
+        self._position = [0] * size
 
     def get_id_count(self):
         i = 0
@@ -174,91 +259,133 @@ class ColorMap:
             i = i + len(lst)
         return i
 
+    def _color(self, id: int) -> int:
+        if id is None or id >= len(self._color_of):
+            return self._NO_COLOR
+        return self._color_of[id]
+
+    def _insert(self, id: int, color: int):
+        if id >= len(self._color_of):
+            grow_by = max(id + 1, 2 * len(self._color_of)) - len(self._color_of)
+            self._color_of.extend([self._NO_COLOR] * grow_by)
+            self._position.extend([0] * grow_by)
+        elif self._color_of[id] != self._NO_COLOR:
+            self.remove(id, self._color_of[id])
+        color_list = self.cmap[color]
+        self._color_of[id] = color
+        self._position[id] = len(color_list)
+        color_list.append(id)
+        self._empty = False
 
     def find(self, id: int) -> int:
-        for color_num in range(self.color_count):
-            id_list = self.cmap[color_num]
-            if id in id_list:
-                return color_num
-        return None
+        color_num = self._color(id)
+        if color_num == self._NO_COLOR or color_num >= self.color_count:
+            return None
+        return color_num
 
     def remove(self, id: int, color: int):
-        self.cmap[color].remove(id)
+        if self._color(id) != color:
+            raise ValueError(f"id {id} is not in color {color}")
+        color_list = self.cmap[color]
+        position = self._position[id]
+        last = color_list.pop()
+        if last != id:
+            color_list[position] = last
+            self._position[last] = position
+        self._color_of[id] = self._NO_COLOR
 
     def add(self, id: int, target_colors: [int] = [0, 1, 2, 3], adjacent_ids: [int] = []) -> int:
+        blocked = {self._color(adjacent_id) for adjacent_id in adjacent_ids}
         for target in target_colors:
-            color_list = self.cmap[target]
-            has_adjacent = False
-            for adjacent_id in adjacent_ids:
-                if adjacent_id in color_list:
-                    has_adjacent = True
-                    break
-            if not has_adjacent:
-                color_list.append(id)
-                self._empty = False
+            if target not in blocked:
+                self._insert(id, target)
                 return target
 
         return -1
 
     def fail(self, id: int):
-        self._empty = False
-        self.cmap[self.color_count].append(id)
+        self._insert(id, self.color_count)
 
     def is_empty(self):
         return self._empty
 
 
 class Cycle:
-    def __init__(self, nx_cycle):
+    def __init__(self, nx_cycle, core_id=None):
         self.cycle = nx_cycle
         self.size = len(self.cycle)
         self.is_odd = self.size % 2 != 0
-        self.all_ids = []
-        core_ids = [x for x in self.cycle[0]]
-        for triple in self.cycle:
-            for id in triple:
-                if id not in self.all_ids:
-                    self.all_ids.append(id)
-        for triple in self.cycle:
-            for id in core_ids:
-                if id not in triple:
-                    core_ids.remove(id)
-            if len(core_ids) == 1:
-                break
-        self.core_id = core_ids[0]
+        self.all_ids = list(dict.fromkeys(id for triple in self.cycle for id in triple))
+        if core_id is None:
+            core_ids = [id for id in self.cycle[0] if all(id in triple for triple in self.cycle)]
+            core_id = core_ids[0]
+        self.core_id = core_id
 
     def __repr__(self):
         return str(self.cycle)
 
 
-def coloring_simple(tri_grid: TriGrid, hex_graph: nx.Graph, color_map=None):
+def score_coloring(grid: TriGrid, cmap) -> dict:
+    """Overflow entries, regions left uncolored and borders between two regions of the same color"""
+    index = grid.region_index()
+    colors = np.full(index.region_count, -1, dtype=np.int64)
+    for color, ids in enumerate(cmap):
+        colors[np.asarray(ids, dtype=np.int64)] = color
+    edge_a, edge_b = index.edges()
+    conflicts = (colors[edge_a] == colors[edge_b]) & (colors[edge_a] >= 0) & (colors[edge_a] < 4)
+    return {
+        "overflow": len(cmap[4]),
+        "uncolored": int(np.count_nonzero(colors < 0)),
+        "conflicts": int(np.count_nonzero(conflicts)),
+    }
+
+
+def coloring_simple(tri_grid: TriGrid, hex_graph: nx.Graph, color_map=None, start_seed=None):
+    # start_seed randomizes the start hex and traversal order, None keeps the graph order
     if color_map is None:
         color_map = ColorMap()
 
+    counters = tracing.stage("coloring_simple")
+    trace = tracing.trace_enabled()
+    rng = None if start_seed is None else random.Random(start_seed)
     start_hexes = build_min_connected_nodes(hex_graph)
+    if rng is not None:
+        rng.shuffle(start_hexes)
     adjacency_map = build_adjacency_map(hex_graph.nodes)
+    hex_count = 0
+    conflicts = 0
+    recolors = 0
+    failures = 0
 
-    print(f"Starting hexes:{start_hexes}")
+    if trace:
+        log.debug("Starting hexes:%s", start_hexes)
 
-    for cur_hex in depth_greedy_traverse_hex(hex_graph, start_hexes):
+    for cur_hex in depth_greedy_traverse_hex(hex_graph, start_hexes, rng):
+        hex_count = hex_count + 1
         reserved_list = [None] * 5
         for id in cur_hex:
             color_num = color_map.find(id)
-            print(f"Found existing color {color_num} for id {id}")
+            if trace:
+                log.debug("Found existing color %s for id %s", color_num, id)
             if color_num is not None:
                 if reserved_list[color_num] is None:
                     reserved_list[color_num] = id
                 else:
+                    conflicts = conflicts + 1
                     alt_colors = list(filter(lambda a: reserved_list[a] is None, range(4)))
                     color_map.remove(id, color_num)
                     alt_color = color_map.add(id, alt_colors, adjacency_map[id])
-                    print(f"Coloring blocked for {cur_hex}(id {id} on color {color_num})!")
-                    print(f" id conflict [{id} , {reserved_list[color_num]}]")
-                    print(f" Moved id {id} to {alt_color} from available colors {alt_colors}")
+                    if trace:
+                        log.debug("Coloring blocked for %s(id %s on color %s)!", cur_hex, id, color_num)
+                        log.debug(" id conflict [%s , %s]", id, reserved_list[color_num])
+                        log.debug(" Moved id %s to %s from available colors %s", id, alt_color, alt_colors)
                     if alt_color > -1:
+                        recolors = recolors + 1
                         reserved_list[alt_color] = id
                     else:
-                        print("Color choice failed!")
+                        failures = failures + 1
+                        if trace:
+                            log.debug("Color choice failed!")
                         reserved_list[4] = id
                         color_map.add(id, [4])
 
@@ -268,9 +395,12 @@ def coloring_simple(tri_grid: TriGrid, hex_graph: nx.Graph, color_map=None):
                 reserved_list[unused_i] = id
                 color_map.add(id, [unused_i])
 
-        print(f"Coloring hex:{cur_hex}:{reserved_list}")
-        print(color_map.cmap)
+        if trace:
+            log.debug("Coloring hex:%s:%s", cur_hex, reserved_list)
+            log.debug("%s", color_map.cmap)
 
+    counters.finish(hexes=hex_count, conflicts=conflicts, recolors=recolors, failures=failures,
+                    overflow=len(color_map.cmap[4]))
     return color_map.cmap
 
 
@@ -303,21 +433,106 @@ def build_hex_to_cycle_map(all_cycles: [Cycle]) -> {}:
     return hex_map
 
 
+def build_id_to_cycle_map(all_cycles: [Cycle]) -> {}:
+    # Every cycle listed under each of its ids
+    id_map = {}
+    for cycle in all_cycles:
+        for id in cycle.all_ids:
+            cycle_list = id_map.get(id)
+            if cycle_list is None:
+                id_map[id] = [cycle]
+            else:
+                cycle_list.append(cycle)
+    return id_map
+
+
 def build_cycle_to_cycle_map(all_cycles: [Cycle]) -> {}:
+    # Neighbors of a cycle are the cycles around the ids it touches
+    core_map = {}
+    for cycle in all_cycles:
+        core_map.setdefault(cycle.core_id, []).append(cycle)
     map = {}
     for cycle in all_cycles:
         neighbors = []
         for id in cycle.all_ids:
-            for potential in all_cycles:
-                if potential is cycle:
-                    continue
-                if potential.core_id == id:
+            for potential in core_map.get(id, ()):
+                if potential is not cycle:
                     neighbors.append(potential)
-            map[cycle] = neighbors
+        map[cycle] = neighbors
     return map
 
 
+def two_edge_connected(neighbours: dict) -> bool:
+    """True when the simple graph given as node -> neighbour list has at least 2 nodes, is connected and has no
+    bridge, the same as nx.is_k_edge_connected(graph, 2)"""
+    if len(neighbours) < 2:
+        return False
+    root = next(iter(neighbours))
+    order = {root: 0}
+    low = {root: 0}
+    stack = [(root, None, iter(neighbours[root]))]
+    while stack:
+        node, parent, remaining = stack[-1]
+        for other in remaining:
+            if other == parent:
+                continue
+            if other in order:
+                low[node] = min(low[node], order[other])
+            else:
+                order[other] = low[other] = len(order)
+                stack.append((other, node, iter(neighbours[other])))
+                break
+        else:
+            stack.pop()
+            if parent is not None:
+                if low[node] > order[parent]:
+                    return False
+                low[parent] = min(low[parent], low[node])
+    return len(order) == len(neighbours)
+
+
+def hex_ring(core_id, hex_list):
+    """Hexes of hex_list ordered around core_id, None if they do not close around it.
+
+    Each hex joins two neighbours of core_id, so the hexes are the edges of a small link graph on those neighbours,
+    and two hexes touch when they share a neighbour.  The hexes close around core_id when the graph of touching hexes
+    is 2-edge-connected, which also admits a ring with extra hexes hanging off it.  They are ordered by a
+    Hierholzer walk of the link graph, a plain ring comes out in ring order and extra hexes are spliced in where
+    the walk meets them.
+    """
+    links = {}
+    for hex in hex_list:
+        for id in hex:
+            if id != core_id:
+                links.setdefault(id, []).append(hex)
+    touching = {hex: [] for hex in hex_list}
+    for link in links.values():
+        for hex in link:
+            touching[hex].extend(other for other in link if other != hex)
+    if not two_edge_connected(touching):
+        return None
+
+    used = set()
+    ring = []
+    stack = [(hex_list[0][0] if hex_list[0][0] != core_id else hex_list[0][1], None)]
+    while stack:
+        id, via_hex = stack[-1]
+        link = links[id]
+        while link and link[-1] in used:
+            link.pop()
+        if link:
+            hex = link.pop()
+            used.add(hex)
+            stack.append((next(other for other in hex if other != core_id and other != id), hex))
+        else:
+            stack.pop()
+            if via_hex is not None:
+                ring.append(via_hex)
+    return ring
+
+
 def build_hex_cycles_by_common_id(hex_graph: nx.Graph):
+    # Every cycle of hexes surrounds the one id they share, so only the hexes of each id need to be looked at
     id_map = {}
     for hex in hex_graph.nodes:
         for id in hex:
@@ -330,232 +545,291 @@ def build_hex_cycles_by_common_id(hex_graph: nx.Graph):
     cycle_list = []
 
     for id, hex_list in id_map.items():
-        subgraph = hex_graph.subgraph(hex_list)
-        if nx.is_k_edge_connected(subgraph, 2):
-            cycle_list.append(Cycle(hex_list))
+        ring = hex_ring(id, hex_list)
+        if ring is not None:
+            cycle_list.append(Cycle(ring, id))
 
     return cycle_list
 
 
-def coloring_neighbored_hex_cycle(tri_grid: TriGrid, hex_graph: nx.Graph, color_map=None):
+def coloring_neighbored_hex_cycle(tri_grid: TriGrid, hex_graph: nx.Graph, color_map=None, start_seed=None):
+    # start_seed shuffles the cycles, which changes how ties are broken
     if color_map is None:
         color_map = ColorMap()
-    # cycles = [Cycle(x) for x in nx.minimum_cycle_basis(hex_graph)]
+    counters = tracing.stage("coloring_neighbored_hex_cycle")
+    trace = tracing.trace_enabled()
     cycles = build_hex_cycles_by_common_id(hex_graph)
+    if start_seed is not None:
+        random.Random(start_seed).shuffle(cycles)
     cycle_neighbor_map = build_cycle_to_cycle_map(cycles)
-
-    def emit_minimally_neighbored_cycle(cycle_list: [Cycle]):
-        while cycle_list:
-            min_cycle = None
-            min_neighbor_count = sys.maxsize
-            for cycle in cycle_list:
-                neighbor_count = len(cycle_neighbor_map.get(cycle))
-                if neighbor_count < min_neighbor_count:
-                    min_neighbor_count = neighbor_count
-                    min_cycle = cycle
-            yield min_cycle
-
-    def get_highest_contention_cycle(cycle_list: [Cycle]) -> Cycle:
-        max_contention = None
-        max_colored_count = 0
-        for cycle in cycle_list:
-            neighbors = cycle_neighbor_map.get(cycle)
-            colored_neighbor_count = 0
-            for neighbor in neighbors:
-                if color_map.find(neighbor.core_id):
-                    colored_neighbor_count = colored_neighbor_count + 1
-            print(f"Contention on cycle {neighbors} is {colored_neighbor_count}")
-            if colored_neighbor_count > max_colored_count:
-                max_contention = cycle
-                max_colored_count = colored_neighbor_count
-        return max_contention
+    id_cycle_map = build_id_to_cycle_map(cycles)
+    order = {cycle: i for i, cycle in enumerate(cycles)}
+    processed = set()
+
+    # Contention is the number of colored neighbors.  Both heaps break ties by the original cycle order and keep
+    # stale entries, which are skipped when popped.
+    contention = {}
+    contention_heap = []
+    for cycle in cycles:
+        colored = [neighbor for neighbor in cycle_neighbor_map[cycle] if color_map.find(neighbor.core_id) is not None]
+        contention[cycle] = len(colored)
+        if contention[cycle] > 0:
+            contention_heap.append((-contention[cycle], order[cycle], cycle))
+    heapq.heapify(contention_heap)
+    neighbor_heap = [(len(cycle_neighbor_map[cycle]), order[cycle], cycle) for cycle in cycles]
+    heapq.heapify(neighbor_heap)
 
     def process_cycle(cycle):
-        try:
-            cycles.remove(cycle)
-        except ValueError:
-            print(f"Double processing {cycle}")
-            return False
+        processed.add(cycle)
         result = color_map.add(cycle.core_id, adjacent_ids=cycle.all_ids)
-        print(f"looking at {cycle.core_id} with adj {cycle.all_ids}")
-        print(f"color {result} for cycle {cycle}")
+        if trace:
+            log.debug("looking at %s with adj %s", cycle.core_id, cycle.all_ids)
+            log.debug("color %s for cycle %s", result, cycle)
         if result == -1:
-            print("!!Coloring Failed!!")
+            if trace:
+                log.debug("!!Coloring Failed!!")
             color_map.fail(cycle.core_id)
             failed_cycles.append(cycle)
+            return
 
-        return True
+        # Only the cycles touching the newly colored core id gain contention
+        for other in id_cycle_map[cycle.core_id]:
+            if other is not cycle and other not in processed:
+                contention[other] = contention[other] + 1
+                heapq.heappush(contention_heap, (-contention[other], order[other], other))
 
     failed_cycles = []
 
-    for next_cycle in emit_minimally_neighbored_cycle(cycles):
+    while neighbor_heap:
+        next_cycle = heapq.heappop(neighbor_heap)[2]
+        if next_cycle in processed:
+            continue
         process_cycle(next_cycle)
-        while True:
-            next_cycle = get_highest_contention_cycle(cycles)
-            if next_cycle is None:
-                break
+        while contention_heap:
+            neg_contention, _, next_cycle = heapq.heappop(contention_heap)
+            if next_cycle in processed or -neg_contention != contention[next_cycle]:
+                continue
             process_cycle(next_cycle)
 
     # coloring_simple(hex_graph, color_map)
 
-    print(f"Failed cycles:{failed_cycles}")
+    if trace:
+        log.debug("Failed cycles:%s", failed_cycles)
+    counters.finish(cycles=len(cycles), failures=len(failed_cycles), overflow=len(color_map.cmap[4]))
 
     return color_map.cmap
 
 
-def coloring_large_hex_cycle(tri_grid: TriGrid, hex_graph: nx.Graph, color_map=None):
+def coloring_large_hex_cycle(tri_grid: TriGrid, hex_graph: nx.Graph, color_map=None, start_seed=None):
+    # start_seed shuffles the cycles, which changes how ties are broken
     if color_map is None:
         color_map = ColorMap()
 
-    cycles = [Cycle(x) for x in nx.minimum_cycle_basis(hex_graph)]
+    counters = tracing.stage("coloring_large_hex_cycle")
+    trace = tracing.trace_enabled()
+    cycles = build_hex_cycles_by_common_id(hex_graph)
+    if start_seed is not None:
+        random.Random(start_seed).shuffle(cycles)
+    # A hex belongs to at most three cycles (one per id), so unlinking a cycle from its hexes is cheap
     hex_cycle_map = build_hex_to_cycle_map(cycles)
-    hex_stack = []
-    for cycle in cycles:
-        for hex in cycle.cycle:
-            cycle_list = hex_cycle_map.get(hex)
-            if cycle_list is None:
-                cycle_list = [cycle]
-                hex_cycle_map[hex] = cycle_list
-            else:
-                cycle_list.append(cycle)
-
-    def get_largest_cycle(cycle_list):
-        while cycle_list:
-            largest_cycle = cycle_list[0]
-            for cycle in cycle_list[1:]:
-                if len(cycle.cycle) > len(largest_cycle.cycle):
-                    largest_cycle = cycle
-            yield largest_cycle
+    processed = set()
+    push_order = itertools.count()
 
     def process_cycle(cycle):
-        try:
-            cycles.remove(cycle)
-        except ValueError:
-            print(f"Double processing {cycle}")
-            return False
+        processed.add(cycle)
         result = color_map.add(cycle.core_id, adjacent_ids=cycle.all_ids)
-        print(f"looking at {cycle.core_id} with adj {cycle.all_ids}")
-        print(f"color {result} for cycle {cycle}")
+        if trace:
+            log.debug("looking at %s with adj %s", cycle.core_id, cycle.all_ids)
+            log.debug("color %s for cycle %s", result, cycle)
         if result == -1:
-            print("!!Coloring Failed!!")
+            if trace:
+                log.debug("!!Coloring Failed!!")
             color_map.fail(cycle.core_id)
             failed_cycles.append(cycle)
 
-        empty_hex_list = []
-
-        for hex, cycle_list in hex_cycle_map.items():
-            try:
+        for hex in cycle.cycle:
+            cycle_list = hex_cycle_map.get(hex)
+            if cycle_list is not None:
                 cycle_list.remove(cycle)
                 if len(cycle_list) == 0:
-                    empty_hex_list.append(hex)
-            except ValueError:
-                pass
-        for hex in empty_hex_list:
-            del hex_cycle_map[hex]
-        return True
+                    del hex_cycle_map[hex]
 
     failed_cycles = []
 
-    for next_cycle in get_largest_cycle(cycles):
-        cycle_stack = [next_cycle]
-        # while cycle_stack:
-        # next_cycle = cycle_stack.pop(0)
-        for next_cycle in get_largest_cycle(cycle_stack):
-            if process_cycle(next_cycle):
-                hex_stack.extend(next_cycle.cycle)
-                while hex_stack:
-                    hex = hex_stack.pop(0)
-                    if hex in hex_cycle_map:
-                        cycle_list = hex_cycle_map.get(hex)
-                        del hex_cycle_map[hex]
-                        cycle_stack.extend(cycle_list)
-            else:
-                cycle_stack.remove(next_cycle)
+    # Largest cycle first, then spread over the cycles sharing its hexes, again largest first
+    for next_cycle in sorted(cycles, key=lambda c: -c.size):
+        if next_cycle in processed:
+            continue
+        cycle_stack = [(-next_cycle.size, next(push_order), next_cycle)]
+        while cycle_stack:
+            next_cycle = heapq.heappop(cycle_stack)[2]
+            if next_cycle in processed:
+                continue
+            process_cycle(next_cycle)
+            for hex in next_cycle.cycle:
+                cycle_list = hex_cycle_map.pop(hex, None)
+                if cycle_list is not None:
+                    for cycle in cycle_list:
+                        heapq.heappush(cycle_stack, (-cycle.size, next(push_order), cycle))
 
     # coloring_simple(hex_graph, color_map)
 
-    print(f"Failed cycles:{failed_cycles}")
+    if trace:
+        log.debug("Failed cycles:%s", failed_cycles)
+    counters.finish(cycles=len(cycles), failures=len(failed_cycles), overflow=len(color_map.cmap[4]))
 
     return color_map.cmap
 
 
-def coloring_recursive_triangulation(tri_grid: TriGrid, hex_graph: nx.Graph, color_map=None):
-    if color_map is not None:
-        raise Exception("Recursive triangulation cannot take existing color map")
-    color_map = ColorMap()
+def coloring_dsatur(tri_grid: TriGrid, hex_graph: nx.Graph, color_map=None, stats=None, start_seed=None):
+    # Works on the region adjacency arrays of the grid, hex_graph is only accepted for the common signature
+    counters = tracing.stage("coloring_dsatur")
+    index = tri_grid.region_index()
+    node_count = max(tri_grid.seed_count(), index.region_count)
+    if color_map is None:
+        color_map = ColorMap(node_count)
 
-    def build_constraints(cell: TriCell):
-        nots = []
-        sames = []
-        unconstrained = True
-        for adj in (cell.a, cell.b, cell.c):
-            if adj is not None:
-                unconstrained = False
-                add_sames = False
-                add_nots = False
-                for id in cell.id:
-                    if id in adj.id and not add_sames:
-                        sames.append(adj)
-                        add_sames = True
-                    elif not add_nots:
-                        nots.append(adj)
-                        add_nots = True
-                    if add_sames and add_nots:
-                        break
-
-        if unconstrained:
-            return None
-        else:
-            return nots, sames
-
-    def solve_constraints(ids: [int], constraints: []) -> {int, int}:
-        solution = {}
-        return solution
-
-    def find_first_coloring(cells: [TriCell]):
-        solution = {}
-        for cell in cells:
-            if len(cell.id) == 2:
-                solution[cell.id[0]] = 0
-                solution[cell.id[1]] = 1
-                return solution
-
-        for cell in cells:
-            if len(cell.id) == 1:
-                solution[0] = [cell.id[0]]
-                return solution
-
-        return solution
-
-    def resolve(cells: [TriCell]):
-        if not color_map.is_empty():
-            constraints = [build_constraints(cell) for cell in cells]
-            solutions = solve_constraints(cell.id, constraints)
-        else:
-            solutions = find_first_coloring(cells)
+    start_colors = [color_map.find(id) for id in range(node_count)]
+    start_colors = [UNCOLORED if color is None else color for color in start_colors]
+    colors, search_stats = dsatur_color(index.adj_ptr, index.adj, node_count, start_colors, color_map.color_count,
+                                        seed=start_seed)
 
-        for id, color in solutions.items():
+    for id, color in enumerate(colors):
+        if color < color_map.color_count:
             color_map.add(id, [color])
+        else:
+            color_map.fail(id)
 
-        if color_map.get_id_count() == tri_grid.seed_count():
-            print("Successful coloring!")
-            return
+    counters.finish(recolors=search_stats["kempe_swaps"] + search_stats["neighbour_moves"],
+                    ejections=search_stats["ejections"], failures=search_stats["failures"])
+    if search_stats["failures"]:
+        log.warning("coloring_dsatur left %s regions on the overflow color", search_stats["failures"])
+    if stats is not None:
+        stats.update(search_stats)
+
+    return color_map.cmap
 
-        #subdivide and recurse
 
+# Views are split with sub_divide until they are at most this high (or of odd height)
+LEAF_HEIGHT = 128
 
 
-    div_size = tri_grid.height
+def subgraph_csr(index, regions: np.ndarray):
+    """CSR adjacency of the regions (sorted ids) among themselves, relabelled to positions in regions"""
+    local = np.full(index.region_count, -1, dtype=np.int64)
+    local[regions] = np.arange(len(regions))
+    starts = index.adj_ptr[regions]
+    counts = index.adj_ptr[regions + 1] - starts
+    owner = np.repeat(np.arange(len(regions)), counts)
+    entry = np.arange(counts.sum()) + np.repeat(starts - (np.cumsum(counts) - counts), counts)
+    neighbours = local[index.adj[entry]]
+    keep = neighbours >= 0
+    ptr = np.zeros(len(regions) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(owner[keep], minlength=len(regions)), out=ptr[1:])
+    return ptr, neighbours[keep]
 
-    while div_size > 2:
-        div_size = div_size / 2
-    if div_size != 2 and div_size != 1:
-        raise Exception("Recursive triangulation only applies to grids that are sizes of 2^n for whole n")
 
-    tri_root = TriCell(0, 0)
-    tri_root.id = list(range(tri_grid.seed_count()))
-    tri_root.state = tri_grid
+def color_subgraph(task):
+    """DSATUR colors of a CSR subgraph and the number of its nodes left on the overflow color"""
+    ptr, adj, colors, seed = task
+    colors, search_stats = dsatur_color(ptr, adj, len(ptr) - 1, colors, seed=seed)
+    return np.asarray(colors, dtype=np.int64), search_stats["failures"]
 
-    resolve([tri_root])
 
+def coloring_recursive_triangulation(tri_grid: TriGrid, hex_graph: nx.Graph, color_map=None, start_seed=None,
+                                     leaf_height=LEAF_HEIGHT, processes=None, stats=None):
+    """Divide and conquer coloring over TriGrid.sub_divide.
+
+    The grid is split into views down to leaf_height.  The regions of every leaf are colored on their own (on a
+    process pool unless already inside a pool worker) and the four colorings of each split are merged bottom up:
+    each child's colors are permuted to agree with the regions it shares with its earlier siblings, the first
+    child keeps shared regions, and one end of every remaining same colored border is recolored by a DSATUR pass
+    with Kempe repair.  Regions still stuck after the last pass get the overflow color, their count goes to
+    stats["failures"] (and a warning) when it is not zero.
+    """
+    if color_map is not None:
+        raise Exception("Recursive triangulation cannot take existing color map")
+    counters = tracing.stage("coloring_recursive_triangulation")
+    color_map = ColorMap()
+    index = tri_grid.region_index()
+    permutations = [np.asarray(p + (color_map.color_count,)) for p in itertools.permutations(range(4))]
+
+    def split(grid):
+        if grid.height <= leaf_height or grid.height % 2 != 0:
+            return grid
+        return [split(view) for view in grid.sub_divide()]
+
+    def leaves(node):
+        if isinstance(node, list):
+            for child in node:
+                yield from leaves(child)
+        else:
+            yield node
+
+    tree = split(tri_grid)
+    leaf_regions = []
+    tasks = []
+    for leaf in leaves(tree):
+        regions = np.unique(leaf.cell_ids())
+        regions = regions[regions >= 0].astype(np.int64)
+        leaf_regions.append(regions)
+        tasks.append(subgraph_csr(index, regions) + (None, start_seed))
+
+    if len(tasks) > 1 and processes != 1 and not multiprocessing.current_process().daemon:
+        with multiprocessing.Pool(processes) as pool:
+            leaf_results = pool.map(color_subgraph, tasks)
+    else:
+        leaf_results = [color_subgraph(task) for task in tasks]
+    # Leaf failures are retried by the merges, only the last pass decides what stays on the overflow color
+    leaf_results = iter(zip(leaf_regions, [colors for colors, _ in leaf_results]))
+    repaired = 0
+
+    def merge(node):
+        nonlocal repaired
+        if not isinstance(node, list):
+            return next(leaf_results)
+        children = [merge(child) for child in node]
+        regions = np.unique(np.concatenate([child_regions for child_regions, _ in children]))
+        ptr, adj = subgraph_csr(index, regions)
+        owner = np.repeat(np.arange(len(regions)), np.diff(ptr))
+        colors = np.full(len(regions), UNCOLORED, dtype=np.int64)
+        for child_regions, child_colors in children:
+            position = np.searchsorted(regions, child_regions)
+            current = colors[position]
+            shared = current != UNCOLORED
+            # Borders from the child's new regions to the regions colored so far
+            child_color = np.full(len(regions), UNCOLORED, dtype=np.int64)
+            child_color[position[~shared]] = child_colors[~shared]
+            border = (child_color[owner] != UNCOLORED) & (colors[adj] != UNCOLORED)
+            border_from = child_color[owner[border]]
+            border_to = colors[adj[border]]
+            best = min(permutations, key=lambda p: np.count_nonzero(p[child_colors[shared]] != current[shared])
+                       + np.count_nonzero(p[border_from] == border_to))
+            colors[position[~shared]] = best[child_colors[~shared]]
+
+        colors[colors >= color_map.color_count] = UNCOLORED
+        clash = (colors[owner] == colors[adj]) & (colors[adj] != UNCOLORED) & (owner < adj)
+        # Freeing the neighbours too gives DSATUR room to order the border regions itself
+        uncolored = colors == UNCOLORED
+        uncolored[adj[clash]] = True
+        uncolored[adj[uncolored[owner]]] = True
+        colors[uncolored] = UNCOLORED
+        if uncolored.any():
+            repaired = repaired + int(np.count_nonzero(uncolored))
+            colors, _ = color_subgraph((ptr, adj, colors.tolist(), start_seed))
+        return regions, colors
+
+    regions, colors = merge(tree)
+    for id, color in zip(regions.tolist(), colors.tolist()):
+        if color < color_map.color_count:
+            color_map.add(id, [color])
+        else:
+            color_map.fail(id)
+
+    failures = len(color_map.cmap[4])
+    counters.finish(leaves=len(tasks), repaired=repaired, failures=failures)
+    if failures:
+        log.warning("coloring_recursive_triangulation left %s regions on the overflow color", failures)
+    if stats is not None:
+        stats["failures"] = failures
     return color_map.cmap
@@ -0,0 +1,71 @@
+"""Trace output and per-stage counters for the grow and coloring stages.
+
+Per step traces go to the "coloring" logger at DEBUG.  Hot loops read trace_enabled() once up front and skip every
+trace call (and its formatting) when it is off.  Each stage also records a StageCounters in a module level report,
+whose summary line is logged at INFO when the stage finishes.
+
+    logging.basicConfig(level=logging.DEBUG)  # full traces
+    tracing.reset()
+    ...
+    print(tracing.format_report())
+"""
+import collections
+import logging
+import time
+
+log = logging.getLogger("coloring")
+
+# Only the most recent stages are kept, so a long GUI session does not accumulate counters forever
+REPORT_SIZE = 256
+
+_stages = collections.deque(maxlen=REPORT_SIZE)
+
+
+def trace_enabled() -> bool:
+    return log.isEnabledFor(logging.DEBUG)
+
+
+class StageCounters:
+    """Named counts (hexes, conflicts, recolors, failures, ...) and the run time of one stage"""
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.counts = {}
+        self.seconds = None
+        self._start = time.time()
+
+    def add(self, name: str, count: int = 1):
+        self.counts[name] = self.counts.get(name, 0) + count
+
+    def finish(self, **counts):
+        for name, count in counts.items():
+            self.add(name, count)
+        self.seconds = time.time() - self._start
+        log.info("%s: %s in %.3fs", self.stage, self.counts, self.seconds)
+        return self
+
+    def as_dict(self):
+        return {"stage": self.stage, "seconds": self.seconds, **self.counts}
+
+
+def stage(name: str) -> StageCounters:
+    counters = StageCounters(name)
+    _stages.append(counters)
+    return counters
+
+
+def reset():
+    _stages.clear()
+
+
+def report() -> [dict]:
+    return [counters.as_dict() for counters in _stages]
+
+
+def format_report() -> str:
+    lines = []
+    for counters in _stages:
+        seconds = "running" if counters.seconds is None else f"{counters.seconds:.3f}s"
+        counts = " ".join(f"{name}={count}" for name, count in counters.counts.items())
+        lines.append(f"{counters.stage:<32} {seconds:>10}  {counts}")
+    return "\n".join(lines)
@@ -1,15 +1,27 @@
-class TriCell:
-    id = None
+import numpy as np
+
+# Id stored for a cell that has not been assigned to a region yet
+NO_ID = -1
+# Id stored in the padding of the rectangular storage (positions that are not cells)
+NO_CELL = -2
 
-    _l = None
-    _r = None
-    _v = None
+ID_DTYPE = np.int32
 
-    state = None
 
-    def __init__(self, x, y):
+class TriCell:
+    """Lightweight handle on a single triangle of a TriGrid.
+
+    id and state are read from and written to the storage of the root grid, so cells can be created and dropped
+    freely.  Coordinates are root grid coordinates.  A TriCell created without a grid holds its own id/state.
+    """
+    __slots__ = ("_grid", "__x", "__y", "_id", "_state")
+
+    def __init__(self, x, y, grid=None):
+        self._grid = grid
         self.__x = x
         self.__y = y
+        self._id = None
+        self._state = None
 
     def __repr__(self):
         return f"(x={self.__x},y={self.__y})"
@@ -17,6 +29,62 @@ class TriCell:
     def __str__(self):
         return self.to_string_with_offset()
 
+    def __eq__(self, other):
+        if not isinstance(other, TriCell):
+            return NotImplemented
+        if self._grid is None or other._grid is None:
+            return self is other
+        return self._grid is other._grid and self.__x == other.__x and self.__y == other.__y
+
+    def __hash__(self):
+        return hash((id(self._grid), self.__x, self.__y))
+
+    @property
+    def id(self):
+        if self._grid is None:
+            return self._id
+        value = self._grid._ids[self.__y, self.__x]
+        return None if value < 0 else int(value)
+
+    @id.setter
+    def id(self, value):
+        if self._grid is None:
+            self._id = value
+        else:
+            self._grid._ids[self.__y, self.__x] = NO_ID if value is None else value
+            self._grid.mark_changed()
+
+    @property
+    def state(self):
+        if self._grid is None:
+            return self._state
+        return self._grid._state.get((self.__x, self.__y), self._grid._default_state)
+
+    @state.setter
+    def state(self, value):
+        if self._grid is None:
+            self._state = value
+        else:
+            self._grid._state[(self.__x, self.__y)] = value
+
+    @property
+    def _l(self):
+        return None if self._grid is None else self._grid._cell(self.__x - 1, self.__y)
+
+    @property
+    def _r(self):
+        return None if self._grid is None else self._grid._cell(self.__x + 1, self.__y)
+
+    @property
+    def _v(self):
+        if self._grid is None:
+            return None
+        x, y = self.__x, self.__y
+        if self._grid.up:
+            return self._grid._cell(x - 1, y - 1) if x % 2 == 1 else self._grid._cell(x + 1, y + 1)
+        else:
+            return self._grid._cell(x + 1, y - 1) if x % 2 == 0 else self._grid._cell(x - 1, y + 1)
+
     def to_string_with_offset(self, offset: (int, int) = (0, 0)):
         if self.id is None:
             return f"<{self.__x + offset[0]:02},{self.__y + offset[1]:02}>"
@@ -37,7 +105,22 @@ class TriCell:
 
 
 class TriGrid:
-    def __init__(self, height: int, up=True, view_source=None, offset: (int, int) = (0, 0)):
+    """Triangle shaped grid of triangles.
+
+    Cell ids are stored in a single (height, 2 * height - 1) array indexed by (y, x).  Row y of an up grid holds
+    2 * y + 1 cells, row y of a down grid holds 2 * (height - y - 1) + 1 cells, the remaining positions are padding
+    filled with NO_CELL.  Unassigned cells hold NO_ID.  Neighbours are computed arithmetically:
+
+    * up grid: even x points up and its v neighbour is (x + 1, y + 1), odd x points down with v at (x - 1, y - 1)
+    * down grid: even x points down and its v neighbour is (x + 1, y - 1), odd x points up with v at (x - 1, y + 1)
+
+    Views (created with view_source) share the storage of their root grid.  A view's local (x, y) maps to root
+    (origin_x + x + shear * y, origin_y + y), where the shear accounts for views of the opposite orientation.
+    A root grid may also be built over an existing id array (ids), for example a memory-mapped one, which is used
+    as is without copying.
+    """
+
+    def __init__(self, height: int, up=True, view_source=None, offset: (int, int) = (0, 0), ids: np.ndarray = None):
         if height < 1:
             raise ValueError("Height must be at least 1")
         if offset[0] < 0 or offset[1] < 0:
@@ -47,40 +130,56 @@ class TriGrid:
         self.offset = offset
         self.up = up
         self._seed_count = 0
+        self._seeds_ = None
 
         if view_source is None:
             if offset[0] != 0 or offset[1] != 0:
                 raise ValueError("view_source parameter is not set."
                                  " Offset can only be non-zero with a provided view_source")
 
-            self.grid_store = [[TriCell(0, 0)]]
-
-            for level in range(1, height) if up else range(height_, 1, -1):
-                next_level = [TriCell(x, level) for x in range(level * 2 + 1)]
-                for cell in next_level:
-                    cx, _ = cell.xy()
-                    if cx > 0:
-                        cell._l = next_level[cx - 1]
-                        cell._l._r = cell
-                    if cx % 2 == 1:
-                        cell._v = self.grid_store[-1][cx - 1]
-                        cell._v._v = cell
-                self.grid_store.append(next_level)
+            self.root = self
+            self.origin = (0, 0)
+            self.shear = 0
+            if ids is None:
+                self._ids = np.full((height, 2 * height - 1), NO_CELL, dtype=ID_DTYPE)
+                for y in range(height):
+                    self._ids[y, :self.get_row_width(y)] = NO_ID
+            elif ids.shape != (height, 2 * height - 1) or ids.dtype != ID_DTYPE:
+                raise ValueError(f"ids must be a {ID_DTYPE.__name__} array of shape {(height, 2 * height - 1)}")
+            else:
+                self._ids = ids
+            self._state = {}
+            self._default_state = None
+            self._version = 0
+            self._region_index = None
         else:
+            if ids is not None:
+                raise ValueError("ids can only be given for a root grid")
             if offset[1] + height > view_source.height:
                 raise ValueError(
                     f"height {height} + y offset {offset[1]} exceeds max height {view_source.height} of view_source")
 
-            if up:
-                if offset[0] + height > view_source.get_row_width(offset[1] + height - 1):
-                    raise ValueError(
-                        f"width {height} + x offset {offset[0]} exceeds width at {view_source.get_row_width(offset[1] + height)}")
+            if up == view_source.up:
+                shear = 0
             else:
-                if offset[0] + height > view_source.get_row_width(offset[1]) - 1:
+                shear = 2 if view_source.up else -2
+
+            # Check the first and last row of the view fit inside the corresponding source rows
+            for y in (0, height - 1):
+                x_first = offset[0] + shear * y
+                x_last = x_first + self.get_row_width(y) - 1
+                source_width = view_source.get_row_width(offset[1] + y)
+                if x_first < 0 or x_last >= source_width:
                     raise ValueError(
-                        f"width {height} + x offset {offset[0]} exceeds width at {view_source.get_row_width(offset[1])}")
+                        f"row {y} of view spans [{x_first}-{x_last}] outside of source width {source_width}")
+                if (x_first % 2 == 0) != (view_source.up == up):
+                    raise ValueError(f"x offset {offset[0]} does not align triangle orientation with view_source")
 
-            self.grid_store = view_source.grid_store
+            self.root = view_source.root
+            self.origin = (view_source.origin[0] + offset[0] + view_source.shear * offset[1],
+                           view_source.origin[1] + offset[1])
+            self.shear = view_source.shear + shear
+            self._ids = self.root._ids
 
     def __repr__(self):
         return f"TriGrid(height={self.height},offset={self.offset},up={self.up})"
@@ -91,6 +190,27 @@ class TriGrid:
 
         return header + "\n" + body
 
+    @property
+    def ids(self):
+        """Id array of the root storage (including padding), shared by all views"""
+        return self._ids
+
+    def is_view(self):
+        return self.root is not self
+
+    def mark_changed(self):
+        """Must be called after writing to ids directly so cached indexes get rebuilt"""
+        self.root._version = self.root._version + 1
+
+    def region_index(self):
+        cached = self._region_index if not self.is_view() else None
+        if cached is not None and cached.version == self.root._version:
+            return cached
+        index = RegionIndex(self)
+        if not self.is_view():
+            self._region_index = index
+        return index
+
     def get_row_width(self, y: int) -> int:
         if y >= self.height:
             raise IndexError(f"y is out of range [0-{self.height - 1}]")
@@ -104,10 +224,20 @@ class TriGrid:
 
     def get_seeds(self):
         if self._seeds_ is None:
-            d = {tri.id: True for tri in self.triangles()}
-            _seeds_ = d.keys()
+            self._seeds_ = sorted(int(i) for i in np.unique(self.cell_ids()) if i >= 0)
         return self._seeds_
 
+    def to_root(self, x: int, y: int) -> (int, int):
+        return self.origin[0] + x + self.shear * y, self.origin[1] + y
+
+    def _cell(self, x: int, y: int):
+        # Root coordinates, only used by TriCell to resolve neighbours
+        if x < 0 or y < 0 or y >= self.height:
+            return None
+        if x >= self.get_row_width(y):
+            return None
+        return TriCell(x, y, self)
+
     def get(self, x: int, y: int):
         if x < 0 or y < 0:
             return None
@@ -115,55 +245,149 @@ class TriGrid:
             return None
         if x >= self.get_row_width(y):
             return None
-        return self.grid_store[y + self.offset[1]][x + self.offset[0]]
+        rx, ry = self.to_root(x, y)
+        return TriCell(rx, ry, self.root)
+
+    def cell_ids(self):
+        """Ids of every cell of this grid (root or view) as a flat array in row order"""
+        if not self.is_view():
+            return self._ids[self._ids != NO_CELL]
+        return np.concatenate([self._row_ids(y) for y in range(self.height)])
+
+    def _row_ids(self, y: int):
+        rx, ry = self.to_root(0, y)
+        return self._ids[ry, rx:rx + self.get_row_width(y)]
 
     def set_all_state(self, state):
-        for tri in self.triangles():
-            tri.state = state
+        if self.is_view():
+            for tri in self.triangles():
+                tri.state = state
+        else:
+            self._state.clear()
+            self._default_state = state
 
     def set_all_id(self, id):
-        for tri in self.triangles():
-            tri.id = id
+        value = NO_ID if id is None else id
+        for y in range(self.height):
+            self._row_ids(y)[:] = value
+        self.mark_changed()
+
+    def cell_mask(self):
+        """Boolean mask over the root storage selecting the cells of this grid"""
+        if not self.is_view():
+            return self._ids != NO_CELL
+        mask = np.zeros(self._ids.shape, dtype=bool)
+        for y in range(self.height):
+            rx, ry = self.to_root(0, y)
+            mask[ry, rx:rx + self.get_row_width(y)] = True
+        return mask
 
     def find_cell_for_id(self, id: int):
-        for tri in self.triangles():
-            if tri.id == id:
-                return cell
-        return None
+        cells = self.region_index().cells(id)
+        if cells.size == 0:
+            return None
+        y, x = divmod(int(cells[0]), self._ids.shape[1])
+        return TriCell(x, y, self.root)
 
     def find_adjacent_ids(self, id: int):
-        adj = {}
-        for cell in self.triangles():
-            if cell.id == id:
-                if cell._l is not None:
-                    if cell._l.id != id:
-                        adj[cell._l.id] = True
-                if cell._r is not None:
-                    if cell._r.id != id:
-                        adj[cell._r.id] = True
-                if cell._v is not None:
-                    if cell._v.id != id:
-                        adj[cell._v.id] = True
-
-        return adj.keys()
+        return self.region_index().adjacent(id).tolist()
+
+    def flat_neighbours(self, flat):
+        """l, r and v neighbours of root cells given as flat indices into ids, as a (3, n) array (-1 for none)"""
+        root = self.root
+        flat = np.asarray(flat, dtype=np.int64)
+        height = root.height
+        width = root._ids.shape[1]
+        y, x = np.divmod(flat, width)
+        odd = x % 2 == 1
+        if root.up:
+            row_last = 2 * y
+            v = np.where(odd, flat - width - 1, np.where(y < height - 1, flat + width + 1, -1))
+        else:
+            row_last = 2 * (height - y - 1)
+            v = np.where(odd, flat + width - 1, np.where(y > 0, flat - width + 1, -1))
+        l = np.where(x > 0, flat - 1, -1)
+        r = np.where(x < row_last, flat + 1, -1)
+        return np.stack((l, r, v))
 
     def triangles(self):
         for y in range(self.height):
-            for x in range(y * 2 + 1):
+            for x in range(self.get_row_width(y)):
                 yield self.get(x, y)
 
     def sub_divide(self):
+        half = self.height // 2
         if self.up:
             return (
-                TriGrid(self.height // 2, up=True, view_source=self, offset=(0, 0)),
-                TriGrid(self.height // 2, up=True, view_source=self, offset=(0, self.height // 2)),
-                TriGrid(self.height // 2, up=False, view_source=self, offset=(1, self.height // 2)),
-                TriGrid(self.height // 2, up=True, view_source=self, offset=(self.height, self.height // 2)),
+                TriGrid(half, up=True, view_source=self, offset=(0, 0)),
+                TriGrid(half, up=True, view_source=self, offset=(0, half)),
+                TriGrid(half, up=False, view_source=self, offset=(1, half)),
+                TriGrid(half, up=True, view_source=self, offset=(self.height, half)),
             )
         else:
             return (
-                TriGrid(self.height // 2, up=False, view_source=self, offset=(0, 0)),
-                TriGrid(self.height // 2, up=True, view_source=self, offset=(self.height // 2, 0)),
-                TriGrid(self.height // 2, up=False, view_source=self, offset=(self.height // 2 + 1, 0)),
-                TriGrid(self.height // 2, up=False, view_source=self, offset=(0, self.height // 2)),
+                TriGrid(half, up=False, view_source=self, offset=(0, 0)),
+                TriGrid(half, up=True, view_source=self, offset=(self.height - 1, 0)),
+                TriGrid(half, up=False, view_source=self, offset=(self.height, 0)),
+                TriGrid(half, up=False, view_source=self, offset=(0, half)),
             )
+
+
+class RegionIndex:
+    """Region adjacency graph and per-region cell lists of a grid, built in a single vectorized pass.
+
+    Every l/r and v edge of the storage is compared once; edges joining two different assigned ids become region
+    adjacencies.  Both the adjacency and the cell lists are stored CSR style: the entries for region i are
+    adj[adj_ptr[i]:adj_ptr[i + 1]] and cells[cell_ptr[i]:cell_ptr[i + 1]] (flat indices into the root ids).
+    """
+
+    def __init__(self, grid: TriGrid):
+        self.version = grid.root._version
+        ids = grid.ids
+        mask = grid.cell_mask()
+        assigned = mask & (ids >= 0)
+
+        flat_cells = np.flatnonzero(assigned)
+        cell_ids = ids.reshape(-1)[flat_cells]
+        self.region_count = int(cell_ids.max()) + 1 if cell_ids.size > 0 else 0
+
+        order = np.argsort(cell_ids, kind="stable")
+        self.cell_flat = flat_cells[order]
+        self.cell_ptr = np.zeros(self.region_count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cell_ids, minlength=self.region_count), out=self.cell_ptr[1:])
+
+        if grid.root.up:
+            vertical = (np.s_[:-1, 0:-1:2], np.s_[1:, 1::2])
+        else:
+            vertical = (np.s_[:-1, 1::2], np.s_[1:, 0:-1:2])
+        keys = []
+        for a_slice, b_slice in ((np.s_[:, :-1], np.s_[:, 1:]), vertical):
+            a = ids[a_slice]
+            b = ids[b_slice]
+            edge = assigned[a_slice] & assigned[b_slice] & (a != b)
+            a = a[edge].astype(np.int64)
+            b = b[edge].astype(np.int64)
+            keys.append(np.minimum(a, b) * self.region_count + np.maximum(a, b))
+        keys = np.unique(np.concatenate(keys))
+        self.edge_a, self.edge_b = np.divmod(keys, max(self.region_count, 1))
+
+        source = np.concatenate((self.edge_a, self.edge_b))
+        target = np.concatenate((self.edge_b, self.edge_a))
+        order = np.argsort(source, kind="stable")
+        self.adj = target[order]
+        self.adj_ptr = np.zeros(self.region_count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(source, minlength=self.region_count), out=self.adj_ptr[1:])
+
+    def edges(self):
+        """Unique region adjacencies as two arrays with edge_a < edge_b"""
+        return self.edge_a, self.edge_b
+
+    def adjacent(self, id: int):
+        if id < 0 or id >= self.region_count:
+            return self.adj[:0]
+        return self.adj[self.adj_ptr[id]:self.adj_ptr[id + 1]]
+
+    def cells(self, id: int):
+        if id < 0 or id >= self.region_count:
+            return self.cell_flat[:0]
+        return self.cell_flat[self.cell_ptr[id]:self.cell_ptr[id + 1]]
@@ -0,0 +1,77 @@
+import queue
+import threading
+
+
+class Cancelled(Exception):
+    pass
+
+
+class BackgroundTask:
+    """Runs fn(progress) on a worker thread and hands progress and the result back to the Tk thread.
+
+    progress(done, total, message) may be called from fn at any rate, it only queues the latest values and raises
+    Cancelled once cancel() has been requested, which is how fn gets interrupted.  fn passes cancellable=False
+    ahead of work that does not call progress, and the task's cancellable attribute (set by the last progress call,
+    or by the constructor for fn that never calls it) tells the Tk side whether a cancel() would be seen.  The Tk
+    side polls the queue with window.after() and calls on_progress/on_done/on_error there, so those callbacks may
+    touch widgets and globals.
+    """
+
+    def __init__(self, window, name, fn, on_done, on_progress=None, on_error=None, poll_ms=50, cancellable=True):
+        self.window = window
+        self.name = name
+        self.cancellable = cancellable
+        self._fn = fn
+        self._on_done = on_done
+        self._on_progress = on_progress
+        self._on_error = on_error
+        self._poll_ms = poll_ms
+        self._cancel = threading.Event()
+        self._events = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        self.window.after(self._poll_ms, self._poll)
+        return self
+
+    def cancel(self):
+        self._cancel.set()
+
+    def is_running(self):
+        return self._thread.is_alive()
+
+    def progress(self, done, total=None, message=None, cancellable=True):
+        if self._cancel.is_set():
+            raise Cancelled(self.name)
+        self.cancellable = cancellable
+        self._events.put(("progress", (done, total, message)))
+
+    def _run(self):
+        try:
+            self._events.put(("done", self._fn(self.progress)))
+        except Cancelled:
+            self._events.put(("cancelled", None))
+        except Exception as e:
+            self._events.put(("error", e))
+
+    def _poll(self):
+        latest_progress = None
+        while True:
+            try:
+                kind, value = self._events.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "progress":
+                latest_progress = value
+                continue
+            if kind == "done":
+                self._on_done(value)
+            elif kind == "error" and self._on_error is not None:
+                self._on_error(self, value)
+            elif kind == "cancelled" and self._on_error is not None:
+                self._on_error(self, None)
+            return
+        if latest_progress is not None and self._on_progress is not None:
+            self._on_progress(self, *latest_progress)
+        self.window.after(self._poll_ms, self._poll)
@@ -1,19 +1,197 @@
-#cython: boundscheck=False,
+#cython: boundscheck=False, wraparound=False
 
 import numpy as np
 cimport numpy as np
 
-def forward_fill_cython(int start,int end,np.ndarray[np.float64_t, ndim=1]  fill_value_map, np.float64_t[:] price_block,np.uint8_t[:] symbol_block):
+def forward_fill_cython(Py_ssize_t start, Py_ssize_t end, np.float64_t[:] fill_value_map, np.float64_t[:] price_block,
+                        np.uint8_t[:] symbol_block):
+    # Forward fills zero prices in [start, end) only.  fill_value_map comes in holding the fill value per symbol (0 to
+    # leave leading gaps alone) and goes out holding the last price per symbol.  Returns the mask of symbols that had a
+    # price in the range.
+    cdef Py_ssize_t i
     cdef unsigned char symbol_id
-
+    seen = np.zeros(fill_value_map.shape[0], dtype=np.uint8)
+    cdef np.uint8_t[:] seen_view = seen
 
     with nogil:
-        for i in range(end):
+        for i in range(start, end):
             symbol_id = symbol_block[i]
             if price_block[i] == 0:
                 price_block[i] = fill_value_map[symbol_id]
             else:
                 fill_value_map[symbol_id] = price_block[i]
+                seen_view[symbol_id] = 1
+    return seen.view(bool)
+
+
+def fill_leading_gaps_cython(Py_ssize_t start, Py_ssize_t end, np.float64_t[:] carry, np.float64_t[:] price_block,
+                             np.uint8_t[:] symbol_block):
+    # Boundary pass after forward_fill_cython filled [start, end) on its own: the zeros left are the entries of each
+    # symbol before its first price in the range, they get carry[symbol].  Stops once every symbol with a non zero
+    # carry has shown a price, returns the index it stopped at.
+    cdef Py_ssize_t i
+    cdef Py_ssize_t symbol_count = carry.shape[0]
+    cdef Py_ssize_t pending_count = 0
+    cdef Py_ssize_t stop = end
+    cdef unsigned char symbol_id
+    pending = np.zeros(symbol_count, dtype=np.uint8)
+    cdef np.uint8_t[:] pending_view = pending
+
+    for i in range(symbol_count):
+        if carry[i] != 0:
+            pending_view[i] = 1
+            pending_count = pending_count + 1
+    if pending_count == 0:
+        return start
+
+    with nogil:
+        for i in range(start, end):
+            symbol_id = symbol_block[i]
+            if price_block[i] == 0:
+                price_block[i] = carry[symbol_id]
+            elif pending_view[symbol_id]:
+                pending_view[symbol_id] = 0
+                pending_count = pending_count - 1
+                if pending_count == 0:
+                    stop = i + 1
+                    break
+    return stop
+
+
+ASOF_BACKWARD = 0
+ASOF_FORWARD = 1
+ASOF_NEAREST = 2
+
+
+def tick_bounds_cython(Py_ssize_t start, Py_ssize_t end, np.int64_t[:] time_block, np.uint8_t[:] symbol_block,
+                       np.float64_t[:] price_block, Py_ssize_t symbol_count):
+    # First and last tick (non zero price) per symbol in [start, end) as (has_tick, first_time, first_price,
+    # last_time, last_price) arrays, the carries of the as-of join
+    cdef Py_ssize_t i
+    cdef unsigned char symbol_id
+    has_tick = np.zeros(symbol_count, dtype=np.uint8)
+    first_time = np.zeros(symbol_count, dtype=np.int64)
+    first_price = np.zeros(symbol_count, dtype=np.float64)
+    last_time = np.zeros(symbol_count, dtype=np.int64)
+    last_price = np.zeros(symbol_count, dtype=np.float64)
+    cdef np.uint8_t[:] has_view = has_tick
+    cdef np.int64_t[:] first_time_view = first_time
+    cdef np.float64_t[:] first_price_view = first_price
+    cdef np.int64_t[:] last_time_view = last_time
+    cdef np.float64_t[:] last_price_view = last_price
+
+    with nogil:
+        for i in range(start, end):
+            if price_block[i] == 0:
+                continue
+            symbol_id = symbol_block[i]
+            if not has_view[symbol_id]:
+                has_view[symbol_id] = 1
+                first_time_view[symbol_id] = time_block[i]
+                first_price_view[symbol_id] = price_block[i]
+            last_time_view[symbol_id] = time_block[i]
+            last_price_view[symbol_id] = price_block[i]
+    return has_tick.view(bool), first_time, first_price, last_time, last_price
+
+
+cdef inline bint within(np.int64_t distance, np.int64_t tolerance) nogil:
+    return tolerance < 0 or distance <= tolerance
+
+
+def asof_join_cython(Py_ssize_t start, Py_ssize_t end, np.int64_t[:] time_block, np.uint8_t[:] symbol_block,
+                     np.float64_t[:] price_block, np.float64_t[:] joined_block, backward_carry, forward_carry,
+                     int direction=ASOF_BACKWARD, bint allow_exact_matches=True, np.int64_t tolerance=-1):
+    # As-of join of the trades (zero price) in [start, end) to the ticks of the same symbol, like pd.merge_asof on
+    # time by symbol.  The matched tick price goes to joined_block at the trade's row, NaN when there is none within
+    # tolerance (negative for no limit).  backward_carry and forward_carry are (has_tick, time, price) arrays with the
+    # last tick per symbol before start and the first one from end on.  Rows sharing a time must not straddle start
+    # or end.  Nearest keeps the backward tick when both are equally close.
+    cdef Py_ssize_t i, group_start, group_end
+    cdef unsigned char symbol_id
+    cdef np.int64_t distance
+    cdef double nan = float("nan")
+    cdef np.uint8_t[:] valid
+    cdef np.int64_t[:] tick_time
+    cdef np.float64_t[:] tick_price
+    cdef np.int64_t[:] backward_distance
+    cdef bint nearest = direction == ASOF_NEAREST
+    cdef bint forward_only = direction == ASOF_FORWARD
 
+    if direction not in (ASOF_BACKWARD, ASOF_FORWARD, ASOF_NEAREST):
+        raise ValueError(f"Unknown as-of direction {direction}")
+    # Distance to the backward match of each row, -1 for none, for the nearest comparison
+    backward_distance = np.full(end - start if nearest else 0, -1, dtype=np.int64)
 
+    if direction != ASOF_FORWARD:
+        valid = np.array(backward_carry[0], dtype=np.uint8)
+        tick_time = np.array(backward_carry[1], dtype=np.int64)
+        tick_price = np.array(backward_carry[2], dtype=np.float64)
+        with nogil:
+            group_start = start
+            while group_start < end:
+                group_end = group_start + 1
+                while group_end < end and time_block[group_end] == time_block[group_start]:
+                    group_end = group_end + 1
+                # Ticks at the trade's own time count for exact matches, so they go in before the trades
+                if allow_exact_matches:
+                    for i in range(group_start, group_end):
+                        if price_block[i] != 0:
+                            symbol_id = symbol_block[i]
+                            valid[symbol_id] = 1
+                            tick_time[symbol_id] = time_block[i]
+                            tick_price[symbol_id] = price_block[i]
+                for i in range(group_start, group_end):
+                    if price_block[i] == 0:
+                        symbol_id = symbol_block[i]
+                        distance = time_block[i] - tick_time[symbol_id]
+                        if valid[symbol_id] and within(distance, tolerance):
+                            joined_block[i] = tick_price[symbol_id]
+                            if nearest:
+                                backward_distance[i - start] = distance
+                        else:
+                            joined_block[i] = nan
+                if not allow_exact_matches:
+                    for i in range(group_start, group_end):
+                        if price_block[i] != 0:
+                            symbol_id = symbol_block[i]
+                            valid[symbol_id] = 1
+                            tick_time[symbol_id] = time_block[i]
+                            tick_price[symbol_id] = price_block[i]
+                group_start = group_end
 
+    if direction != ASOF_BACKWARD:
+        valid = np.array(forward_carry[0], dtype=np.uint8)
+        tick_time = np.array(forward_carry[1], dtype=np.int64)
+        tick_price = np.array(forward_carry[2], dtype=np.float64)
+        with nogil:
+            group_end = end
+            while group_end > start:
+                group_start = group_end - 1
+                while group_start > start and time_block[group_start - 1] == time_block[group_end - 1]:
+                    group_start = group_start - 1
+                # Walked backwards so the first of several ticks at one time is the one kept
+                if allow_exact_matches:
+                    for i in range(group_end - 1, group_start - 1, -1):
+                        if price_block[i] != 0:
+                            symbol_id = symbol_block[i]
+                            valid[symbol_id] = 1
+                            tick_time[symbol_id] = time_block[i]
+                            tick_price[symbol_id] = price_block[i]
+                for i in range(group_start, group_end):
+                    if price_block[i] == 0:
+                        symbol_id = symbol_block[i]
+                        distance = tick_time[symbol_id] - time_block[i]
+                        if valid[symbol_id] and within(distance, tolerance):
+                            if forward_only or backward_distance[i - start] < 0 \
+                                    or distance < backward_distance[i - start]:
+                                joined_block[i] = tick_price[symbol_id]
+                        elif forward_only:
+                            joined_block[i] = nan
+                if not allow_exact_matches:
+                    for i in range(group_end - 1, group_start - 1, -1):
+                        if price_block[i] != 0:
+                            symbol_id = symbol_block[i]
+                            valid[symbol_id] = 1
+                            tick_time[symbol_id] = time_block[i]
+                            tick_price[symbol_id] = price_block[i]
+                group_end = group_start
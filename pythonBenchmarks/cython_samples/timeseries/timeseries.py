@@ -1,9 +1,13 @@
 import time
 import ctypes
+import json
 import multiprocessing
+import os
+from multiprocessing import resource_tracker, shared_memory
 from functools import wraps, partial
 
-from forward_fill import forward_fill_cython
+from forward_fill import forward_fill_cython, fill_leading_gaps_cython, tick_bounds_cython, asof_join_cython, \
+    ASOF_BACKWARD, ASOF_FORWARD, ASOF_NEAREST
 
 import numpy as np
 import pandas as pd
@@ -26,7 +30,13 @@ RAND_SEED = 0  # use None for different results between runs
 ITEMS_IN_ARRAY = 1_000_000_000
 BLOCK_SIZE = 10_000_000
 PROCESS_COUNT = 16
-MODE = "cython"  # "cpython"/"cython"/"pandas"
+MODE = "cython"  # "cpython"/"cython"/"pandas"/"asof"
+ASOF_DIRECTION = "backward"  # "backward"/"forward"/"nearest" as in pd.merge_asof
+ASOF_TOLERANCE = None  # largest time distance between a trade and its tick, None for no limit
+ASOF_ALLOW_EXACT_MATCHES = True
+GAP_CHUNK = 4096  # rows per vectorized step when filling leading gaps without Cython
+STORAGE = "memory"  # "memory"/"mmap", mmap keeps the columns in .npy files under DATA_DIR and reuses them
+DATA_DIR = "timeseries_data"
 
 
 def explode_symbols(symbols):
@@ -75,112 +85,308 @@ def generate_symbol_prices(start_index: int):
 
 @timed_void_fn
 def bulk_forward_fill(start_index: int, block_size: int, symbol_count: int):
+    # Fills the block from its own prices, returns the last price per symbol and which symbols had one
     fill_value_map = np.empty(symbol_count, np.double)
     fill_value_map[:] = 0
+    seen = np.zeros(symbol_count, bool)
     if MODE == "cpython":
-        forward_fill_cpython(start_index, start_index + block_size, fill_value_map=fill_value_map)
+        seen = forward_fill_cpython(start_index, start_index + block_size, fill_value_map=fill_value_map)
     elif MODE == "cython":
-        forward_fill_cython(start_index, start_index + block_size, fill_value_map=fill_value_map,
-                            price_block=price_array, symbol_block=symbol_array)
+        seen = forward_fill_cython(start_index, start_index + block_size, fill_value_map=fill_value_map,
+                                   price_block=price_array, symbol_block=symbol_array)
     else:
         print("SKIPPING Operation.  Set MODE to one of : cpython,cython,pandas")
-    return fill_value_map
+    return fill_value_map, seen
 
 
 def forward_fill_cpython(start: int, end: int, fill_value_map):
     # print(f"start = {start} end = {end}")
+    seen = np.zeros(len(fill_value_map), bool)
     for i in range(start, end):
         symbol_id = symbol_array[i]
         if price_array[i] == 0:  # Initial implementation used none/NAN but was 3X slower on this check
             price_array[i] = fill_value_map[symbol_id]
         else:
             fill_value_map[symbol_id] = price_array[i]
+            seen[symbol_id] = True
+    return seen
+
+
+def combine_block_carries(last_value_maps, seen_masks):
+    # Serial step of the scan: the value each block starts from is the previous block's last price, or the carry
+    # into the previous block for symbols that had no price in it
+    carries = [np.zeros_like(last_value_maps[0])]
+    for last_value_map, seen in zip(last_value_maps[:-1], seen_masks[:-1]):
+        carries.append(np.where(seen, last_value_map, carries[-1]))
+    return carries
+
+
+def fill_leading_gaps_numpy(start: int, end: int, carry):
+    # Vectorized fill_leading_gaps_cython, walks the block in GAP_CHUNK steps until every carried symbol had a price
+    pending = carry != 0
+    position = start
+    while position < end and pending.any():
+        stop = min(position + GAP_CHUNK, end)
+        prices = price_array[position:stop]
+        symbols = symbol_array[position:stop]
+        gaps = prices == 0
+        prices[gaps] = carry[symbols[gaps]]
+        pending[symbols[~gaps]] = False
+        position = stop
+    return position
 
 
 @timed_void_fn
-def boundary_forward_fill(start_index: int, last_value_maps):
-    last_value_map = last_value_maps[start_index // BLOCK_SIZE - 1]
-    known_fills = np.empty(len(SYMBOLS), bool)
-    known_fills[:] = False
-    for i in range(start_index, start_index + BLOCK_SIZE):
-        symbol_id = symbol_array[i]
-        if price_array[i] == 0:
-            price_array[i] = last_value_map[symbol_id]
-        else:
-            if not known_fills[symbol_id]:
-                known_fills[symbol_id] = True
-                if sum(known_fills == False) == 0:
-                    return
+def boundary_forward_fill(start_index: int, carries):
+    # Only the zeros before each symbol's first price in the block are left, they take the carry into the block
+    carry = carries[start_index // BLOCK_SIZE]
+    if MODE == "cython":
+        fill_leading_gaps_cython(start_index, start_index + BLOCK_SIZE, carry=carry,
+                                 price_block=price_array, symbol_block=symbol_array)
+    else:
+        fill_leading_gaps_numpy(start_index, start_index + BLOCK_SIZE, carry=carry)
 
 
-def construct_pandas_df():
-    tick_count = np.count_nonzero(price_array)
-    trade_count = price_array.size - tick_count
+ASOF_DIRECTIONS = {"backward": ASOF_BACKWARD, "forward": ASOF_FORWARD, "nearest": ASOF_NEAREST}
 
-    print(f"Tick:{tick_count}, Trades:{trade_count}")
-    tick_time = np.zeros(tick_count, dtype=ctypes.c_int64)
-    trade_time =  np.zeros(trade_count, dtype=ctypes.c_int64)
-    tick_symbols = np.zeros(tick_count, dtype=ctypes.c_uint8)
-    trade_symbols = np.zeros(trade_count, dtype=ctypes.c_uint8)
-    tick_prices = np.zeros(tick_count, dtype=ctypes.c_double)
-
-    trade_index = 0
-    tick_index = 0
-
-    for i in range(ITEMS_IN_ARRAY):
-        if price_array[i] == 0:
-            trade_time[trade_index] = time_array[i]
-            trade_symbols[trade_index] = symbol_array[i]
-            trade_index = trade_index + 1
-        else:
-            tick_time[tick_index] = time_array[i]
-            tick_symbols[tick_index] = symbol_array[i]
-            tick_prices[tick_index] = price_array[i]
-            tick_index = tick_index + 1
 
-    tick_pd = pd.DataFrame({"time":tick_time , "symbol": tick_symbols,"price": tick_prices})
-    trade_pd = pd.DataFrame({"time":trade_time, "symbol": trade_symbols})
+def asof_block_bounds():
+    # Blocks start at the first row of their time, so rows sharing a time never straddle two blocks
+    starts = np.searchsorted(time_array, time_array[BLOCK_SIZE::BLOCK_SIZE], side="left")
+    starts = np.unique(np.concatenate(([0], starts, [time_array.size])))
+    return list(zip(starts[:-1].tolist(), starts[1:].tolist()))
+
+
+@timed_void_fn
+def block_tick_bounds(bounds, symbol_count: int):
+    return tick_bounds_cython(bounds[0], bounds[1], time_array, symbol_array, price_array, symbol_count)
+
+
+def combine_tick_carries(tick_bounds):
+    # Serial step of the join: the last tick per symbol before each block and the first tick after it, blocks without
+    # a tick of a symbol pass the carry through
+    symbol_count = len(tick_bounds[0][0])
+    empty = (np.zeros(symbol_count, bool), np.zeros(symbol_count, np.int64), np.zeros(symbol_count, np.double))
+
+    def combine(carry, has_tick, tick_time, tick_price):
+        return has_tick | carry[0], np.where(has_tick, tick_time, carry[1]), np.where(has_tick, tick_price, carry[2])
+
+    backward = [empty]
+    for has_tick, _, _, last_time, last_price in tick_bounds[:-1]:
+        backward.append(combine(backward[-1], has_tick, last_time, last_price))
+    forward = [empty]
+    for has_tick, first_time, first_price, _, _ in tick_bounds[:0:-1]:
+        forward.append(combine(forward[-1], has_tick, first_time, first_price))
+    forward.reverse()
+    return backward, forward
+
+
+@timed_void_fn
+def asof_join_block(task):
+    (start, end), backward_carry, forward_carry = task
+    tolerance = -1 if ASOF_TOLERANCE is None else ASOF_TOLERANCE
+    asof_join_cython(start, end, time_array, symbol_array, price_array, joined_price_array, backward_carry,
+                     forward_carry, ASOF_DIRECTIONS[ASOF_DIRECTION], ASOF_ALLOW_EXACT_MATCHES, tolerance)
+
+
+def asof_joined_trades():
+    # Trade rows with the price they joined to (NaN when unmatched)
+    trades = price_array == 0
+    return time_array[trades], symbol_array[trades], joined_price_array[trades]
+
+
+# Columns of the tick/trade split, each filled through a shared memory block sized once the counts are known
+TICK_COLUMNS = (("time", ctypes.c_int64), ("symbol", ctypes.c_uint8), ("price", ctypes.c_double))
+TRADE_COLUMNS = (("time", ctypes.c_int64), ("symbol", ctypes.c_uint8))
+
+
+def count_block_ticks(start_index: int):
+    return np.count_nonzero(price_array[start_index:start_index + BLOCK_SIZE])
+
+
+def attach_columns(names, columns, count: int):
+    blocks = [shared_memory.SharedMemory(name=name) for name in names]
+    for block in blocks:
+        # The pool may predate the creator's resource tracker, the worker's own tracker must not unlink the block
+        resource_tracker.unregister(block._name, "shared_memory")
+    return blocks, [np.ndarray(count, dtype=dtype, buffer=block.buf) for block, (_, dtype) in zip(blocks, columns)]
+
+
+@timed_void_fn
+def scatter_block(task):
+    # Compacts one block into its slice of the tick and trade columns, at the offsets from the prefix sum of counts
+    start_index, tick_offset, trade_offset, tick_names, tick_count, trade_names, trade_count = task
+    block = slice(start_index, start_index + BLOCK_SIZE)
+    ticks = price_array[block] != 0
+    trades = ~ticks
+    tick_end = tick_offset + np.count_nonzero(ticks)
+    trade_end = trade_offset + BLOCK_SIZE - (tick_end - tick_offset)
+
+    tick_blocks, (tick_time, tick_symbols, tick_prices) = attach_columns(tick_names, TICK_COLUMNS, tick_count)
+    trade_blocks, (trade_time, trade_symbols) = attach_columns(trade_names, TRADE_COLUMNS, trade_count)
+    np.compress(ticks, time_array[block], out=tick_time[tick_offset:tick_end])
+    np.compress(ticks, symbol_array[block], out=tick_symbols[tick_offset:tick_end])
+    np.compress(ticks, price_array[block], out=tick_prices[tick_offset:tick_end])
+    np.compress(trades, time_array[block], out=trade_time[trade_offset:trade_end])
+    np.compress(trades, symbol_array[block], out=trade_symbols[trade_offset:trade_end])
+    del tick_time, tick_symbols, tick_prices, trade_time, trade_symbols
+    for shared in tick_blocks + trade_blocks:
+        shared.close()
+
+
+def construct_pandas_df(worker_pool):
+    # Block parallel split: count the ticks per block, prefix sum the counts into each block's output offsets, then
+    # every worker compacts its own block into shared output columns
+    block_starts = range(0, ITEMS_IN_ARRAY, BLOCK_SIZE)
+    block_tick_counts = np.asarray(worker_pool.map(count_block_ticks, block_starts), dtype=np.int64)
+    tick_offsets = np.concatenate(([0], np.cumsum(block_tick_counts)))
+    trade_offsets = np.asarray(block_starts, dtype=np.int64) - tick_offsets[:-1]
+    tick_count = int(tick_offsets[-1])
+    trade_count = ITEMS_IN_ARRAY - tick_count
+
+    print(f"Tick:{tick_count}, Trades:{trade_count}")
+    tick_blocks = [shared_memory.SharedMemory(create=True, size=max(tick_count * ctypes.sizeof(dtype), 1))
+                   for _, dtype in TICK_COLUMNS]
+    trade_blocks = [shared_memory.SharedMemory(create=True, size=max(trade_count * ctypes.sizeof(dtype), 1))
+                    for _, dtype in TRADE_COLUMNS]
+    try:
+        tick_names = [block.name for block in tick_blocks]
+        trade_names = [block.name for block in trade_blocks]
+        worker_pool.map(scatter_block, [
+            (start_index, int(tick_offset), int(trade_offset), tick_names, tick_count, trade_names, trade_count)
+            for start_index, tick_offset, trade_offset in zip(block_starts, tick_offsets, trade_offsets)])
+
+        # The frames get their own copy, the shared blocks are released below
+        tick_pd = pd.DataFrame({name: np.ndarray(tick_count, dtype=dtype, buffer=block.buf).copy()
+                                for block, (name, dtype) in zip(tick_blocks, TICK_COLUMNS)})
+        trade_pd = pd.DataFrame({name: np.ndarray(trade_count, dtype=dtype, buffer=block.buf).copy()
+                                 for block, (name, dtype) in zip(trade_blocks, TRADE_COLUMNS)})
+    finally:
+        for block in tick_blocks + trade_blocks:
+            block.close()
+            block.unlink()
 
     return tick_pd, trade_pd
 
+# .npy file and dtype of every stored column, with the generation stage that writes it
+STORED_COLUMNS = {"time": ("time.npy", ctypes.c_int64, "times"),
+                  "symbol": ("symbol.npy", ctypes.c_uint8, "prices"),
+                  "price": ("price.npy", ctypes.c_double, "prices")}
+METADATA_FILE = "metadata.json"
+
+
+def data_set_key():
+    # Everything the generated columns depend on, the blocks matter as every block reseeds the generator
+    return json.loads(json.dumps({"rand_seed": RAND_SEED, "items": ITEMS_IN_ARRAY, "block_size": BLOCK_SIZE,
+                                  "symbols": SYMBOLS}))
+
+
+def read_stored_stages():
+    # Generation stages whose output is stored in DATA_DIR for the current data set key
+    try:
+        with open(os.path.join(DATA_DIR, METADATA_FILE)) as f:
+            metadata = json.load(f)
+    except (OSError, ValueError):
+        return set()
+    if RAND_SEED is None or {key: metadata.get(key) for key in data_set_key()} != data_set_key():
+        return set()
+    return set(metadata.get("stages", ()))
+
+
+def write_stored_stages(stages):
+    path = os.path.join(DATA_DIR, METADATA_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump({**data_set_key(), "stages": sorted(stages)}, f)
+    os.replace(path + ".tmp", path)
+
+
+def open_column(file_name: str, dtype, reuse: bool):
+    # Memory maps a stored column, a new (zero filled) file unless reuse is set and the file fits the current size
+    path = os.path.join(DATA_DIR, file_name)
+    if reuse:
+        try:
+            column = np.load(path, mmap_mode="r+")
+            if column.shape == (ITEMS_IN_ARRAY,) and column.dtype == np.dtype(dtype):
+                return column, True
+        except (OSError, ValueError):
+            pass
+    return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=(ITEMS_IN_ARRAY,)), False
+
+
+def open_stored_columns():
+    # time, symbol and price columns mapped from DATA_DIR, and the generation stages that need not run again
+    os.makedirs(DATA_DIR, exist_ok=True)
+    stages = read_stored_stages()
+    columns = {}
+    for name, (file_name, dtype, stage) in STORED_COLUMNS.items():
+        columns[name], reused = open_column(file_name, dtype, stage in stages)
+        if not reused:
+            stages.discard(stage)
+    # Rewrite the stored stages first, so an interrupted run can not leave them claiming half written columns
+    write_stored_stages(stages)
+    return columns["time"], columns["symbol"], columns["price"], stages
+
+
 if __name__ == '__main__':
     print("Creating Arrays")
 
-    main_array_base = multiprocessing.Array(ctypes.c_int64, ITEMS_IN_ARRAY, lock=False)
-    symbol_array_base = multiprocessing.Array(ctypes.c_int8, ITEMS_IN_ARRAY, lock=False)
-    price_array_base = multiprocessing.Array(ctypes.c_double, ITEMS_IN_ARRAY, lock=False)
-
-    boundary_array_base = multiprocessing.Array(ctypes.c_int64, ITEMS_IN_ARRAY // BLOCK_SIZE, lock=False)
+    if STORAGE == "mmap":
+        time_array, symbol_array, price_array, stored_stages = open_stored_columns()
+    else:
+        main_array_base = multiprocessing.Array(ctypes.c_int64, ITEMS_IN_ARRAY, lock=False)
+        symbol_array_base = multiprocessing.Array(ctypes.c_int8, ITEMS_IN_ARRAY, lock=False)
+        price_array_base = multiprocessing.Array(ctypes.c_double, ITEMS_IN_ARRAY, lock=False)
 
-    time_array = np.frombuffer(main_array_base, dtype=ctypes.c_int64)
+        time_array = np.frombuffer(main_array_base, dtype=ctypes.c_int64)
 
-    symbol_array = np.frombuffer(symbol_array_base, dtype=ctypes.c_uint8)
-    price_array = np.frombuffer(price_array_base, dtype=ctypes.c_double)
+        symbol_array = np.frombuffer(symbol_array_base, dtype=ctypes.c_uint8)
+        price_array = np.frombuffer(price_array_base, dtype=ctypes.c_double)
+        stored_stages = set()
 
+    boundary_array_base = multiprocessing.Array(ctypes.c_int64, ITEMS_IN_ARRAY // BLOCK_SIZE, lock=False)
     boundary_array = np.frombuffer(boundary_array_base, dtype=ctypes.c_int64)
 
+    if MODE == "asof" and STORAGE == "mmap":
+        joined_price_array, _ = open_column("joined_price.npy", ctypes.c_double, reuse=False)
+    elif MODE == "asof":
+        joined_price_array_base = multiprocessing.Array(ctypes.c_double, ITEMS_IN_ARRAY, lock=False)
+        joined_price_array = np.frombuffer(joined_price_array_base, dtype=ctypes.c_double)
+
     worker_pool = multiprocessing.Pool(processes=PROCESS_COUNT)
 
-    print("Running build_local_times")
     stage_start_time = start_time = time.time()
-    worker_pool.map(build_local_times, range(0, ITEMS_IN_ARRAY, BLOCK_SIZE))
-    print(time.time() - stage_start_time)
-
-    print("Running broadcast_boundary_times")
-    stage_start_time = time.time()
-    boundary_array.cumsum(out=boundary_array)
-    worker_pool.map(broadcast_boundary_times, range(BLOCK_SIZE, ITEMS_IN_ARRAY, BLOCK_SIZE))
-    print(time.time() - stage_start_time)
-
-    print("Running generate_symbol_prices")
-    stage_start_time = time.time()
-    worker_pool.map(generate_symbol_prices, range(0, ITEMS_IN_ARRAY, BLOCK_SIZE))
-    print(time.time() - stage_start_time)
+    if "times" in stored_stages:
+        print(f"Reusing stored times from {DATA_DIR}")
+    else:
+        print("Running build_local_times")
+        worker_pool.map(build_local_times, range(0, ITEMS_IN_ARRAY, BLOCK_SIZE))
+        print(time.time() - stage_start_time)
+
+        print("Running broadcast_boundary_times")
+        stage_start_time = time.time()
+        boundary_array.cumsum(out=boundary_array)
+        worker_pool.map(broadcast_boundary_times, range(BLOCK_SIZE, ITEMS_IN_ARRAY, BLOCK_SIZE))
+        print(time.time() - stage_start_time)
+
+    if "prices" in stored_stages:
+        print(f"Reusing stored symbols and prices from {DATA_DIR}")
+    else:
+        print("Running generate_symbol_prices")
+        stage_start_time = time.time()
+        worker_pool.map(generate_symbol_prices, range(0, ITEMS_IN_ARRAY, BLOCK_SIZE))
+        print(time.time() - stage_start_time)
+
+    if STORAGE == "mmap":
+        for column in (time_array, symbol_array, price_array):
+            column.flush()
+        # Forward filling overwrites the zero prices that mark trades, so the stored prices are only kept for modes
+        # that leave them alone and get generated again otherwise
+        write_stored_stages({"times", "prices"} if MODE in ("pandas", "asof") else {"times"})
     print(price_array[0:100])
     if MODE == "pandas":
         stage_start_time = start_time = time.time()
-        print("Splitting data into Pandas Dataframes (Warning: this is slow and single threaded)")
-        [pandas_ticks_df, pandas_trades_df] = construct_pandas_df()
+        print("Splitting data into Pandas Dataframes")
+        [pandas_ticks_df, pandas_trades_df] = construct_pandas_df(worker_pool)
         print(pandas_trades_df.head(100).to_string())
         print(pandas_ticks_df.head(100).to_string())
         print(time.time() - stage_start_time)
@@ -190,15 +396,28 @@ if __name__ == '__main__':
         print(time.time() - stage_start_time)
         print (results_pd.head(100).to_string())
         pass
+    elif MODE == "asof":
+        print(f"Running {ASOF_DIRECTION} as-of join")
+        stage_start_time = start_time = time.time()
+        block_bounds = asof_block_bounds()
+        closure = partial(block_tick_bounds, symbol_count=int(len(SYMBOLS)))
+        backward_carries, forward_carries = combine_tick_carries([p[0] for p in worker_pool.map(closure, block_bounds)])
+        worker_pool.map(asof_join_block, zip(block_bounds, backward_carries, forward_carries))
+        print(time.time() - stage_start_time)
+        trade_time, trade_symbols, trade_prices = asof_joined_trades()
+        print(f"Trades:{trade_time.size}, unmatched:{np.count_nonzero(np.isnan(trade_prices))}")
+        print(f"total time = {time.time() - start_time} seconds")
+        print(trade_prices[0:100])
     else:
         print("Running bulk_forward_fill")
         stage_start_time = time.time()
         # closure = partial(bulk_forward_fill_cpython, block_size=BLOCK_SIZE, symbol_count=int(len(SYMBOLS)))
         closure = partial(bulk_forward_fill, block_size=BLOCK_SIZE, symbol_count=int(len(SYMBOLS)))
         bulk_out = worker_pool.map(closure, range(0, ITEMS_IN_ARRAY, BLOCK_SIZE))
-        last_value_maps = [p[0] for p in bulk_out]
+        last_value_maps = [p[0][0] for p in bulk_out]
+        seen_masks = [p[0][1] for p in bulk_out]
         print(time.time() - stage_start_time)
-        closure = partial(boundary_forward_fill, last_value_maps=last_value_maps)
+        closure = partial(boundary_forward_fill, carries=combine_block_carries(last_value_maps, seen_masks))
         if MODE != "pandas":
             print("Running boundary_forward_fill")
             stage_start_time = time.time()